@@ -0,0 +1,11 @@
+"""
+Reproducible benchmarks for mush.
+
+Generate synthetic datastores with benchmarks.generate, and time mush
+against them with benchmarks.run, e.g.:
+
+    python -m benchmarks.run --aliases 10000 --variables 300 -o results.json
+    python -m benchmarks.run --compare results.json
+
+Nothing in here is installed with mush.
+"""
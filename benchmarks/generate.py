@@ -0,0 +1,141 @@
+"""
+Generates synthetic mush datastores (and a config that uses them) of any
+size.  The same arguments and seed always produce the same files.
+
+    python -m benchmarks.generate --aliases 10000 --variables 300 \
+        --secret-density 0.05 --data-store csv <directory>
+"""
+import argparse
+import csv
+import os
+import random
+
+# Shared by many aliases, like auth urls and regions are in real datastores
+REGIONS = ['DFW', 'ORD', 'IAD', 'LON', 'HKG', 'SYD']
+AUTH_URLS = [
+    'https://identity.example.com/v2.0/',
+    'https://lon.identity.example.com/v2.0/']
+
+CONFIG = """[default_plugins]
+persist_shell=bash
+access_secret=exec_bash
+data_store={data_store}
+
+[mush]
+cache_dir={directory}/cache
+
+[access_secret.exec_bash]
+magic_prefix=EXEC_BASH:
+
+[data_store.csv]
+location={directory}/datastore.csv
+
+[data_store.supernova]
+location={directory}/supernova
+"""
+
+
+def alias_names(count):
+    return ["{0}-{1:05d}".format(
+        REGIONS[i % len(REGIONS)].lower(), i) for i in range(count)]
+
+
+def variable_names(count):
+    names = ['OS_AUTH_URL', 'OS_REGION_NAME', 'OS_USERNAME', 'OS_PASSWORD']
+    names.extend(
+        "MUSH_BENCH_VAR_{0:04d}".format(i)
+        for i in range(max(0, count - len(names))))
+    return names[:count]
+
+
+def value(rng, alias_number, variable, secret_density):
+    if rng.random() < secret_density:
+        return "EXEC_BASH:echo secret-{0}".format(alias_number)
+    if variable == 'OS_AUTH_URL':
+        return AUTH_URLS[alias_number % len(AUTH_URLS)]
+    if variable == 'OS_REGION_NAME':
+        return REGIONS[alias_number % len(REGIONS)]
+    if variable == 'OS_USERNAME':
+        return "user{0}".format(alias_number)
+    # Mostly blank or repeated values, with some unique ones
+    roll = rng.random()
+    if roll < 0.5:
+        return ''
+    if roll < 0.8:
+        return "shared-{0}".format(rng.randint(0, 9))
+    return "value-{0}-{1}".format(alias_number, rng.randint(0, 999999))
+
+
+def environments(aliases, variables, secret_density, seed):
+    """Yields (alias, [(variable, value), ...]) for every alias"""
+    rng = random.Random(seed)
+    for n, alias in enumerate(alias_names(aliases)):
+        yield alias, [
+            (v, value(rng, n, v, secret_density))
+            for v in variable_names(variables)]
+
+
+def write_csv(path, aliases, variables, secret_density=0.0, seed=0):
+    envs = list(environments(aliases, variables, secret_density, seed))
+    with open(path, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow([''] + [alias for alias, env in envs])
+        for row, variable in enumerate(variable_names(variables)):
+            writer.writerow([variable] + [env[row][1] for a, env in envs])
+
+
+def write_supernova(path, aliases, variables, secret_density=0.0, seed=0):
+    with open(path, 'w') as supernova_file:
+        for alias, env in environments(
+                aliases, variables, secret_density, seed):
+            supernova_file.write("[{0}]\n".format(alias))
+            for variable, val in env:
+                supernova_file.write("{0}={1}\n".format(variable, val))
+            supernova_file.write("\n")
+
+
+def write_workspace(
+        directory, data_store='csv', aliases=100, variables=30,
+        secret_density=0.0, seed=0):
+    """Writes a datastore and a .mush/config that uses it into directory.
+    mush picks the config up when run with directory as the working
+    directory."""
+    directory = os.path.abspath(directory)
+    if not os.path.isdir(os.path.join(directory, '.mush')):
+        os.makedirs(os.path.join(directory, '.mush'))
+    if data_store == 'csv':
+        write_csv(
+            os.path.join(directory, 'datastore.csv'), aliases, variables,
+            secret_density, seed)
+    else:
+        write_supernova(
+            os.path.join(directory, 'supernova'), aliases, variables,
+            secret_density, seed)
+    with open(os.path.join(directory, '.mush', 'config'), 'w') as cfg:
+        cfg.write(CONFIG.format(data_store=data_store, directory=directory))
+    return directory
+
+
+def add_arguments(parser):
+    parser.add_argument('--aliases', type=int, default=100)
+    parser.add_argument('--variables', type=int, default=30)
+    parser.add_argument(
+        '--secret-density', type=float, default=0.0,
+        help="Fraction of values that are EXEC_BASH: secrets")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--data-store', choices=['csv', 'supernova'], default='csv')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    add_arguments(parser)
+    parser.add_argument('directory')
+    args = parser.parse_args()
+    write_workspace(
+        args.directory, args.data_store, args.aliases, args.variables,
+        args.secret_density, args.seed)
+
+
+if __name__ == '__main__':
+    main()
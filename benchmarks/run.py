@@ -0,0 +1,234 @@
+"""
+Times mush against a synthetic datastore and writes the results as JSON.
+
+End to end benchmarks run the mush CLI in a fresh interpreter, exactly as a
+shell would, for 'aliases', 'datastore --all-aliases' and a multi-alias
+'call' of a no-op client.  Micro benchmarks time plugin loading, csv
+parsing, environment_variables and the access_secret pipeline in process.
+
+    python -m benchmarks.run --aliases 10000 --variables 300 -o new.json
+    python -m benchmarks.run --aliases 10000 --variables 300 \
+        --compare old.json
+"""
+import argparse
+import json
+import os
+import pkgutil
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from benchmarks import generate
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUN_CLI = "import sys; from mush.cli import CLI; CLI.run(sys.argv)"
+
+
+def stats(timings):
+    timings = sorted(timings)
+    middle = len(timings) // 2
+    median = timings[middle] if len(timings) % 2 else \
+        (timings[middle - 1] + timings[middle]) / 2.0
+    return {
+        'runs': len(timings),
+        'min': timings[0],
+        'median': median,
+        'mean': sum(timings) / len(timings),
+        'max': timings[-1]}
+
+
+def measure(function, repeat, setup=None):
+    timings = []
+    for n in range(repeat):
+        if setup:
+            setup()
+        start = timeit.default_timer()
+        function()
+        timings.append(timeit.default_timer() - start)
+    return stats(timings)
+
+
+def end_to_end(workspace, args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (REPO, env.get('PYTHONPATH')) if p)
+    env.pop('MUSH_PROFILE', None)
+    devnull = open(os.devnull, 'w')
+    aliases = generate.alias_names(args.aliases)[:args.call_aliases]
+    cache_dir = os.path.join(workspace, 'cache')
+
+    def mush(*cli_args):
+        def run():
+            returncode = subprocess.call(
+                [sys.executable, '-c', RUN_CLI] + list(cli_args),
+                cwd=workspace, env=env, stdout=devnull, stderr=devnull)
+            if returncode:
+                raise RuntimeError(
+                    "mush {0} exited with {1}".format(
+                        " ".join(cli_args), returncode))
+        return run
+
+    def clear_cache():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    results = dict()
+    results['cli.aliases.cold'] = measure(
+        mush('aliases'), args.repeat, setup=clear_cache)
+    mush('aliases')()
+    results['cli.aliases'] = measure(mush('aliases'), args.repeat)
+    results['cli.datastore.all_aliases'] = measure(
+        mush('datastore', '--all-aliases', '--show-blanks'), args.repeat)
+    results['cli.call'] = measure(
+        mush(*(aliases + ['true'])), args.repeat)
+    results['cli.call.parallel'] = measure(
+        mush(*(aliases + ['--parallel=8', 'true'])), args.repeat)
+    devnull.close()
+    return results
+
+
+def micro(workspace, args):
+    # mush reads ./.mush/config when it is first imported
+    os.chdir(workspace)
+    sys.path.insert(0, REPO)
+    from mush import api, engine, plugins
+
+    aliases = generate.alias_names(args.aliases)[:args.call_aliases]
+    results = dict()
+    plugin_modules = [
+        name for loader, name, is_pkg in
+        pkgutil.walk_packages(plugins.__path__)]
+
+    def unload_plugins():
+        for name in plugin_modules:
+            sys.modules.pop(name, None)
+
+    results['api.load'] = measure(
+        lambda: api.load([plugins.__path__]), args.repeat,
+        setup=unload_plugins)
+
+    data_store_class = engine.registry.plugin(
+        'data_store', args.data_store)
+    if args.data_store == 'csv':
+        from mush.store import CompactStore
+
+        def fresh():
+            data_store = data_store_class.__new__(data_store_class)
+            data_store.data_file = os.path.join(workspace, 'datastore.csv')
+            data_store._column_headers = list()
+            data_store._row_headers = list()
+            data_store._store = CompactStore()
+            return data_store
+        parse_targets = []
+        results['data_store._parse_csv'] = measure(
+            lambda: parse_targets.pop()._parse_csv(), args.repeat,
+            setup=lambda: parse_targets.append(fresh()))
+
+    results['data_store.__init__'] = measure(data_store_class, args.repeat)
+    data_store = data_store_class()
+
+    def environments():
+        for alias in aliases:
+            data_store.environment_variables(alias)
+    results['data_store.environment_variables'] = measure(
+        environments, args.repeat)
+
+    raw_env = dict(next(generate.environments(
+        1, args.variables, args.secret_density, args.seed))[1])
+    pipeline = engine.fallthrough_pipeline('access_secret')(
+        lambda self, alias: dict(raw_env))
+
+    def pipelines():
+        for alias in aliases:
+            pipeline(None, alias)
+    results['engine.fallthrough_pipeline'] = measure(pipelines, args.repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints how each benchmark changed against baseline.  Returns True
+    if any got slower by more than threshold"""
+    regressed = False
+    print "{0:<40} {1:>12} {2:>12} {3:>8}".format(
+        "benchmark", "baseline", "current", "ratio")
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['median']
+        new = results[name]['median']
+        ratio = new / old if old else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressed = True
+            flag = '  REGRESSION'
+        print "{0:<40} {1:>12.6f} {2:>12.6f} {3:>8.2f}{4}".format(
+            name, old, new, ratio, flag)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    generate.add_arguments(parser)
+    parser.add_argument(
+        '--call-aliases', type=int, default=10,
+        help="How many aliases the call benchmarks use")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--skip-end-to-end', action='store_true',
+        help="Only run the in-process micro benchmarks")
+    parser.add_argument('-o', '--output', help="Write results JSON here")
+    parser.add_argument('--compare', help="Baseline results JSON")
+    parser.add_argument(
+        '--threshold', type=float, default=1.2,
+        help="Slowdown ratio that counts as a regression (default 1.2)")
+    args = parser.parse_args()
+
+    workspace = tempfile.mkdtemp(prefix='mush-bench-')
+    try:
+        generate.write_workspace(
+            workspace, args.data_store, args.aliases, args.variables,
+            args.secret_density, args.seed)
+        results = dict()
+        if not args.skip_end_to_end:
+            results.update(end_to_end(workspace, args))
+        results.update(micro(workspace, args))
+    finally:
+        os.chdir(REPO)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    output = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {
+                'data_store': args.data_store,
+                'aliases': args.aliases,
+                'variables': args.variables,
+                'secret_density': args.secret_density,
+                'seed': args.seed,
+                'call_aliases': args.call_aliases,
+                'repeat': args.repeat}},
+        'results': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['meta']['parameters'] != output['meta']['parameters']:
+            print "Warning: baseline was run with different parameters"
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
+    else:
+        for name in sorted(results):
+            print "{0:<40} median {1:.6f}s".format(
+                name, results[name]['median'])
+
+
+if __name__ == '__main__':
+    main()
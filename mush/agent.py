@@ -0,0 +1,369 @@
+"""
+An optional resident process, like ssh-agent, that keeps mush's config, the
+loaded plugins, the datastore and resolved environments in memory, and
+serves them to the mush CLI over a Unix socket only the user can use.
+
+When an agent is running, the CLI asks it for environments instead of
+loading the datastore and resolving secrets itself.  When none is running
+(or MUSH_NO_AGENT is set) the CLI works exactly as it does without one.
+
+The protocol is one JSON object per line in each direction.  Requests have
+an 'op' of 'ping', 'aliases', 'environments' (with a list of 'aliases'),
+'variable_values' (with a 'variable'), 'flush' (with an optional list of
+'aliases') or 'stop'.  Responses have
+'ok', and either the requested data or an 'error'.
+"""
+import json
+import os
+import socket
+import SocketServer
+import struct
+import threading
+import time
+from collections import OrderedDict
+from mush import cache, engine
+
+# How long a connecting client may take to send its request
+CLIENT_TIMEOUT = 10
+
+
+def socket_path():
+    path = os.environ.get('MUSH_AGENT_SOCK') or engine.config.get_option(
+        'agent', 'socket') or engine.config.cache_path('agent.sock')
+    return os.path.abspath(os.path.expanduser(path))
+
+
+class AgentError(Exception):
+    pass
+
+
+class Agent(object):
+    """The state an agent serves: a data_store, and the environments it has
+    resolved.  The config and datastore files are checked before every
+    request, and whatever depends on a changed file is reloaded."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data_store = None
+        self.environments = dict()
+        self.variables = dict()
+        self.config_signature = None
+        self.data_store_signature = None
+        # Resolved environments are re-resolved after this many seconds,
+        # so that expiring secrets get refreshed
+        self.environment_ttl = float(engine.config.get_option(
+            'agent', 'environment_ttl', 300))
+
+    def refresh(self):
+        config_signature = cache.file_signature(engine.config._cfgpath)
+        if config_signature != self.config_signature:
+            if self.config_signature is not None:
+                engine.config.reload()
+            self.config_signature = config_signature
+            self.data_store = None
+            engine.secret_cache(reload=True)
+        if self.data_store is not None:
+            data_store_signature = cache.file_signature(
+                *self.data_store.source_files())
+            if data_store_signature != self.data_store_signature:
+                self.data_store = None
+        if self.data_store is None:
+            from mush import api
+            self.data_store = api.data_store()
+            self.data_store_signature = cache.file_signature(
+                *self.data_store.source_files())
+            self.environments = dict()
+            self.variables = dict()
+
+    def aliases(self):
+        with self.lock:
+            self.refresh()
+            return list(self.data_store.available_aliases())
+
+    def variable_values(self, variable):
+        with self.lock:
+            self.refresh()
+            if variable not in self.variables:
+                self.variables[variable] = \
+                    self.data_store.variable_values(variable)
+            return self.variables[variable]
+
+    def groups(self):
+        with self.lock:
+            self.refresh()
+            return self.data_store.groups()
+
+    def resolve(self, aliases, resolve_secrets=True, keys=None):
+        """Returns [(alias, [(variable, value)])].  Resolved environments
+        are kept whole, so resolve_secrets='lazy' is the same as True."""
+        with self.lock:
+            self.refresh()
+            if not resolve_secrets:
+                return [
+                    (alias, list(env.items())) for alias, env in
+                    self.data_store.environment_variables_many(
+                        aliases, resolve_secrets=False, keys=keys)]
+            now = time.time()
+            missing = [
+                a for a in aliases if a not in self.environments or
+                self.environments[a][0] + self.environment_ttl <= now]
+            if missing:
+                # Let secrets be looked up again, rather than reusing what
+                # plugins remembered from earlier runs
+                loaded = engine.registry.plugins('access_secret') or {}
+                for plugin in loaded.values():
+                    plugin.reset()
+            for alias, env in \
+                    self.data_store.environment_variables_many(missing):
+                self.environments[alias] = (now, list(env.items()))
+            if keys is not None:
+                keys = set(keys)
+                return [
+                    (a, [(k, v) for k, v in self.environments[a][1]
+                         if k in keys])
+                    for a in aliases]
+            return [(a, self.environments[a][1]) for a in aliases]
+
+    def flush(self, aliases=None):
+        with self.lock:
+            for alias in (aliases or list(self.environments)):
+                self.environments.pop(alias, None)
+            engine.secret_cache(reload=True)
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        if not self.server.permitted(self.connection):
+            return
+        self.connection.settimeout(CLIENT_TIMEOUT)
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.respond(request)
+        except Exception as exception:
+            response = {'ok': False, 'error': str(exception)}
+        self.wfile.write(json.dumps(response) + "\n")
+
+
+class AgentServer(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, agent):
+        self.agent = agent
+        self.path = path
+        cache.ensure_dir(os.path.dirname(path))
+        umask = os.umask(0o177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+
+    def permitted(self, connection):
+        """Only serve processes running as the same user as the agent, on
+        platforms that can tell (the socket's mode covers the rest)"""
+        peercred = getattr(socket, 'SO_PEERCRED', None)
+        if peercred is None:
+            return True
+        credentials = connection.getsockopt(
+            socket.SOL_SOCKET, peercred, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', credentials)
+        return uid == os.getuid()
+
+    def respond(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return {
+                'ok': True, 'pid': os.getpid(),
+                'config': engine.config._cfgpath}
+        if op == 'aliases':
+            return {'ok': True, 'aliases': self.agent.aliases()}
+        if op == 'environments':
+            return {
+                'ok': True,
+                'environments': self.agent.resolve(
+                    request['aliases'],
+                    request.get('resolve_secrets', True),
+                    request.get('keys'))}
+        if op == 'variable_values':
+            return {
+                'ok': True,
+                'values': self.agent.variable_values(request['variable'])}
+        if op == 'groups':
+            return {'ok': True, 'groups': self.agent.groups()}
+        if op == 'flush':
+            self.agent.flush(request.get('aliases'))
+            return {'ok': True}
+        if op == 'stop':
+            threading.Thread(target=self.shutdown).start()
+            return {'ok': True}
+        return {'ok': False, 'error': "Unknown op '{0}'".format(op)}
+
+    def serve(self):
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class AgentClient(object):
+
+    def __init__(self, path=None):
+        self.path = path or socket_path()
+
+    def request(self, op, **kwargs):
+        kwargs['op'] = op
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.path)
+            connection.sendall(json.dumps(kwargs) + "\n")
+            response = json.loads(connection.makefile('rb').readline())
+        finally:
+            connection.close()
+        if not response.get('ok'):
+            raise AgentError(response.get('error'))
+        return response
+
+    def ping(self):
+        """Returns the agent's response to a ping ({'pid', 'config'}), or
+        None if no agent is listening"""
+        try:
+            return self.request('ping')
+        except (socket.error, ValueError, AgentError):
+            return None
+
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class AgentDataStore(object):
+    """Stands in for the configured data_store, getting everything from a
+    running agent"""
+
+    def __init__(self, client):
+        self.client = client
+        self._aliases = None
+
+    def available_aliases(self):
+        if self._aliases is None:
+            self._aliases = [
+                _to_str(a) for a in self.client.request('aliases')['aliases']]
+        return self._aliases
+
+    def environment_variables(self, alias, **kwargs):
+        return next(self.environment_variables_many([alias], **kwargs))[1]
+
+    def environment_variables_many(self, aliases, resolve_secrets=True,
+                                   keys=None):
+        aliases = list(aliases)
+        response = self.client.request(
+            'environments', aliases=aliases, resolve_secrets=resolve_secrets,
+            keys=keys if keys is None else list(keys))
+        for alias, items in response['environments']:
+            yield _to_str(alias), OrderedDict(
+                (_to_str(k), _to_str(v)) for k, v in items)
+
+    def variable_values(self, variable):
+        values = self.client.request(
+            'variable_values', variable=variable)['values']
+        return dict((_to_str(a), _to_str(v)) for a, v in values.items())
+
+    def groups(self):
+        groups = self.client.request('groups')['groups']
+        return dict(
+            (_to_str(g), [_to_str(a) for a in aliases])
+            for g, aliases in groups.items())
+
+    def source_files(self):
+        return []
+
+    def version(self):
+        # The agent keeps its own copy up to date
+        return None
+
+
+def _running_client():
+    """Returns an AgentClient for the running agent, if there is one and it
+    uses the same config file as this process"""
+    if os.environ.get('MUSH_NO_AGENT'):
+        return None
+    client = AgentClient()
+    if not os.path.exists(client.path):
+        return None
+    status = client.ping()
+    if status is None or status.get('config') != engine.config._cfgpath:
+        return None
+    return client
+
+
+def data_store():
+    """Returns an AgentDataStore if an agent is running, otherwise None"""
+    client = _running_client()
+    return AgentDataStore(client) if client else None
+
+
+def flush(aliases=None):
+    """Tells a running agent, if there is one, to forget resolved
+    environments"""
+    client = _running_client()
+    if client:
+        client.request('flush', aliases=aliases)
+
+
+def status():
+    """Returns the running agent's ping response, or None"""
+    return AgentClient().ping()
+
+
+def start(foreground=False):
+    """Starts an agent listening on socket_path().  Unless foreground is
+    set, the agent runs as a daemon and this returns its pid once it is
+    accepting connections."""
+    path = socket_path()
+    client = AgentClient(path)
+    running = client.ping()
+    if running is not None:
+        raise AgentError(
+            "An agent (pid {0}) is already listening on {1}".format(
+                running['pid'], path))
+    if os.path.exists(path):
+        os.remove(path)
+
+    if foreground:
+        AgentServer(path, Agent()).serve()
+        return os.getpid()
+
+    if os.fork():
+        # Wait for the daemon to start answering
+        for attempt in range(100):
+            running = client.ping()
+            if running is not None:
+                return running['pid']
+            time.sleep(0.05)
+        raise AgentError("The agent did not start")
+
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    try:
+        AgentServer(path, Agent()).serve()
+    finally:
+        os._exit(0)
+
+
+def stop():
+    client = AgentClient()
+    running = client.ping()
+    if running is None:
+        raise AgentError("No agent is listening on {0}".format(client.path))
+    client.request('stop')
+    return running['pid']
@@ -0,0 +1,186 @@
+"""
+Expands alias selectors given on the command line into aliases.
+
+    @prod               Every alias tagged 'prod'
+    dfw-*               Every alias matching a shell style glob
+    re:^iad-.*-admin$   Every alias matching a regular expression
+
+Tags are read from a variable in the datastore (MUSH_TAGS by default, set
+[mush] tag_variable to change it) holding a comma or space separated list
+of tags, and any groups the datastore has (such as supernova's) are tags
+too.  Reading every alias' tags means looking at every alias, so they are
+kept in the cache directory, and only read again when the datastore's
+version changes.
+
+Glob and regex selectors that start with literal text only look at the
+range of the sorted alias names sharing that prefix.
+"""
+import bisect
+import fnmatch
+import hashlib
+import marshal
+import re
+from mush import cache, engine
+
+TAG_SEPARATORS = re.compile(r'[\s,]+')
+GLOB_CHARACTERS = '*?['
+REGEX_PREFIX = 're:'
+# Bump whenever the layout of the cached tags changes
+INDEX_VERSION = 3
+TAG_PREFIX = '@'
+# Characters that end the literal text at the start of a regex
+REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
+
+def tag_variable():
+    return engine.config.get_option('mush', 'tag_variable', 'MUSH_TAGS')
+
+
+def is_selector(arg):
+    return arg.startswith(TAG_PREFIX) or arg.startswith(REGEX_PREFIX) or \
+        any(c in arg for c in GLOB_CHARACTERS)
+
+
+class SelectorError(Exception):
+    pass
+
+
+def _regex_prefix(pattern):
+    """Returns the literal text every match of an anchored pattern starts
+    with, or '' if there is none"""
+    if not pattern.startswith('^') or '|' in pattern:
+        return ''
+    prefix = []
+    for c in pattern[1:]:
+        if c in REGEX_SPECIAL:
+            # A quantifier makes the character before it optional
+            if c in '*?{' and prefix:
+                prefix.pop()
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+
+def _glob_prefix(pattern):
+    for i, c in enumerate(pattern):
+        if c in GLOB_CHARACTERS:
+            return pattern[:i]
+    return pattern
+
+
+class AliasIndex(object):
+    """Answers alias membership and selector queries over a datastore's
+    aliases.  tags is either a dict of tag to list of aliases, or a
+    callable returning one, called the first time a tag is selected."""
+
+    def __init__(self, aliases, tags=None):
+        self.aliases = list(aliases)
+        self._members = frozenset(self.aliases)
+        self._tags = tags
+        self._positions = None
+        self._sorted = None
+
+    def __contains__(self, alias):
+        return alias in self._members
+
+    def __len__(self):
+        return len(self.aliases)
+
+    @property
+    def tags(self):
+        if callable(self._tags) or self._tags is None:
+            self._tags = self._tags() if self._tags else dict()
+        return self._tags
+
+    def _candidates(self, prefix):
+        """Returns the aliases starting with prefix"""
+        if self._sorted is None:
+            self._sorted = sorted(self._members)
+        if not prefix:
+            return self._sorted
+        start = bisect.bisect_left(self._sorted, prefix)
+        end = start
+        while end < len(self._sorted) and \
+                self._sorted[end].startswith(prefix):
+            end += 1
+        return self._sorted[start:end]
+
+    def _in_order(self, aliases):
+        """Returns aliases in the order the datastore lists them"""
+        if self._positions is None:
+            self._positions = dict()
+            for i, alias in enumerate(self.aliases):
+                self._positions.setdefault(alias, i)
+        return sorted(aliases, key=self._positions.__getitem__)
+
+    def select(self, selector):
+        """Returns the aliases selector matches, in datastore order"""
+        if selector.startswith(TAG_PREFIX):
+            return self._in_order(
+                a for a in set(self.tags.get(selector[1:], []))
+                if a in self._members)
+        if selector.startswith(REGEX_PREFIX):
+            pattern = selector[len(REGEX_PREFIX):]
+            try:
+                regex = re.compile(pattern)
+            except re.error as exception:
+                raise SelectorError(
+                    "Invalid regular expression '{0}': {1}".format(
+                        pattern, exception))
+            return self._in_order(
+                a for a in self._candidates(_regex_prefix(pattern))
+                if regex.search(a))
+        regex = re.compile(fnmatch.translate(selector))
+        return self._in_order(
+            a for a in self._candidates(_glob_prefix(selector))
+            if regex.match(a))
+
+
+def parse_tags(variable_values):
+    """Turns a mapping of alias to tag list string into a dict of tag to
+    list of aliases"""
+    tags = dict()
+    for alias, value in variable_values.items():
+        for tag in TAG_SEPARATORS.split(value or ''):
+            if tag:
+                tags.setdefault(tag, list()).append(alias)
+    return tags
+
+
+def _read_tags(data_store):
+    tags = parse_tags(data_store.variable_values(tag_variable()))
+    for group, aliases in data_store.groups().items():
+        members = tags.setdefault(group, list())
+        members.extend(a for a in aliases if a not in members)
+    return tags
+
+
+def datastore_tags(data_store):
+    """Returns the tags of data_store's aliases, from the cache directory if
+    they were read from the same version of the datastore before"""
+    version = data_store.version()
+    if not version:
+        return _read_tags(data_store)
+    key = [INDEX_VERSION, tag_variable(), version]
+    path = engine.config.cache_path(
+        'alias_index', hashlib.sha1(
+            type(data_store).__module__ + ':' +
+            getattr(data_store, '__keyname__', '')).hexdigest() + '.index')
+    try:
+        with open(path, 'rb') as index_file:
+            if marshal.load(index_file) == key:
+                return marshal.load(index_file)
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    tags = _read_tags(data_store)
+    try:
+        cache.atomic_write(path, marshal.dumps(key) + marshal.dumps(tags))
+    except (IOError, OSError, ValueError):
+        # The cached copy is only an optimization, carry on without it
+        pass
+    return tags
+
+
+def for_data_store(data_store):
+    return AliasIndex(
+        data_store.available_aliases(), lambda: datastore_tags(data_store))
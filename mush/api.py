@@ -1,10 +1,23 @@
 """
 Automatically builds the api from the available interface implementations
+
+Plugin modules are only imported when a plugin they define is asked for.
+Which module defines which (interface, keyname) is recorded in a manifest
+that is built by importing every plugin once, cached in the mush cache
+directory, and rebuilt whenever a file in a plugin path changes.  Modules
+that failed to import (e.g. for a missing dependency) are recorded too, and
+imported again whenever a plugin the manifest doesn't know of is asked for,
+in case one of them defines it now.
 """
+import json
+import os
 import pkgutil
-from mush import plugins, engine
+import sys
+from mush import cache, engine, instrument, interfaces, plugins
 __loaded__ = False
 
+MANIFEST_VERSION = 2
+
 
 class _APICallClass(object):
 
@@ -16,11 +29,26 @@ class _APICallClass(object):
         if kwargs.get('keyname'):
             keyname = kwargs.get('keyname')
             kwargs.pop('keyname')
-        return engine.registry['plugins'][self.interface].get(keyname)(
+        return engine.registry.plugin(self.interface, keyname)(
             *args, **kwargs)
 
 
-def load(plugin_paths=None):
+def _import(loader, module_name):
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    try:
+        with instrument.timed('plugins.import', module=module_name):
+            return loader.find_module(module_name).load_module(module_name)
+    except Exception as exception:
+        print >> sys.stderr, (
+            "Plugin API issue: Unable to load plugin '{0}':\n\t{1}".format(
+                module_name, str(exception)))
+
+
+def load(plugin_paths=None, failed=None):
+    """Imports every plugin module found in plugin_paths, registering all
+    the plugins they define.  Returns {module_name: path} for each module
+    that imported cleanly, and adds those that didn't to failed, if given"""
     plugin_paths = plugin_paths or list()
 
     def path_generator(*paths):
@@ -29,23 +57,124 @@ def load(plugin_paths=None):
                 yield loader, module_name, is_pkg
 
     # Identify, recursively, every module in the target cafe package
+    modules = dict()
     for loader, module_name, is_pkg in path_generator(*plugin_paths):
         # Import the current module
+        if _import(loader, module_name):
+            modules[module_name] = loader.path
+        elif failed is not None:
+            failed[module_name] = loader.path
+    return modules
+
+
+def _plugins_of(modules):
+    """Returns {interface: {keyname: [path, module_name]}} for the plugins
+    registered by modules, a dict of module_name to path"""
+    found = dict()
+    for interface_name, keynames in engine.registry.plugins().items():
+        for keyname, plugin in keynames.items():
+            if plugin.__module__ in modules:
+                found.setdefault(interface_name, dict())[keyname] = [
+                    modules[plugin.__module__], plugin.__module__]
+    return found
+
+
+class PluginManifest(object):
+    """Maps (interface, keyname) to the module that defines the plugin, so
+    that plugins can be imported on demand"""
+
+    def __init__(self, plugin_paths):
+        self.plugin_paths = plugin_paths
+        self.path = engine.config.cache_path('plugin_manifest.json')
+        self.failed = dict()
+        self._retried = False
+        self.plugins = self._read()
+        if self.plugins is None:
+            self.plugins = self._build()
+            self._retried = True
+
+    def _signature(self):
+        files = []
+        for paths in self.plugin_paths:
+            for path in paths:
+                for dirpath, dirnames, filenames in os.walk(path):
+                    files.extend(
+                        os.path.join(dirpath, f) for f in filenames
+                        if f.endswith('.py'))
+        return cache.file_signature(*sorted(files))
+
+    def _read(self):
         try:
-            module = \
-                loader.find_module(module_name).load_module(module_name)
-        except Exception as exception:
-            print(
-                "Plugin API issue: Unable to load plugin '{0}':\n\t{1}".format(
-                    module.__name__, str(exception)))
-            continue
-
-# Load plugin modules
-if not __loaded__:
+            with open(self.path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, ValueError):
+            return None
+        if manifest.get('version') != MANIFEST_VERSION or \
+                manifest.get('signature') != self._signature():
+            return None
+        self.failed = manifest.get('failed', dict())
+        return manifest.get('plugins')
+
+    def _write(self):
+        try:
+            cache.atomic_write(self.path, json.dumps({
+                'version': MANIFEST_VERSION,
+                'signature': self._signature(),
+                'plugins': self.plugins,
+                'failed': self.failed}))
+        except (IOError, OSError):
+            # The manifest is only an optimization, carry on without it
+            pass
+
+    def _build(self):
+        self.plugins = _plugins_of(load(self.plugin_paths, self.failed))
+        self._write()
+        return self.plugins
+
+    def _retry(self):
+        """Imports the modules that failed to import before again (once per
+        run), in case whatever they were missing has since been installed"""
+        if self._retried or not self.failed:
+            return
+        self._retried = True
+        modules = dict()
+        for module_name, path in self.failed.items():
+            if _import(pkgutil.get_importer(path), str(module_name)):
+                modules[module_name] = path
+        if modules:
+            for interface_name, keynames in _plugins_of(modules).items():
+                self.plugins.setdefault(interface_name, dict()).update(
+                    keynames)
+            for module_name in modules:
+                del self.failed[module_name]
+            self._write()
+
+    def keynames(self, interface_name):
+        return list(self.plugins.get(interface_name, dict()))
+
+    def load(self, interface_name, keyname):
+        entry = self.plugins.get(interface_name, dict()).get(keyname)
+        if not entry:
+            self._retry()
+            entry = self.plugins.get(interface_name, dict()).get(keyname)
+        if entry:
+            path, module_name = entry
+            _import(pkgutil.get_importer(path), str(module_name))
+
+
+def load_all():
+    """Imports every plugin, for callers that need the complete registry"""
     load([plugins.__path__])
+
+
+# Index plugin modules
+if not __loaded__:
+    with instrument.timed('plugins.manifest'):
+        engine.registry.manifest = PluginManifest([plugins.__path__])
     __loaded__ = True
 
-# Build API
+# Build API (the interfaces register themselves when mush.interfaces is
+# imported, so this doesn't need any plugin modules)
 for interface_class in engine.registry.get('interfaces'):
     if interface_class.__api_visible__:
         globals()[interface_class.__name__] = _APICallClass(
@@ -0,0 +1,100 @@
+"""
+Helpers for the files mush keeps in its cache directory.  Everything written
+here is private to the user: directories are created 0700 and files 0600.
+"""
+import errno
+import json
+import os
+import tempfile
+import time
+
+
+def ensure_dir(path):
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def atomic_write(path, data, mode=0o600):
+    """Writes data to a temporary file next to path and renames it into
+    place, so readers never see a partially written file"""
+    directory = ensure_dir(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_signature(*paths):
+    """Returns a list of [path, mtime, size] for every path that exists,
+    suitable for detecting when any of those files change"""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        signature.append([path, stat.st_mtime, stat.st_size])
+    return signature
+
+
+class TTLCache(object):
+    """A dict of entries persisted as a JSON file readable only by the user.
+    Every entry carries its own expiry time and is dropped once expired."""
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._dirty = False
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as cache_file:
+                    self._entries = json.load(cache_file)
+            except (IOError, ValueError):
+                self._entries = dict()
+            now = time.time()
+            for key, entry in list(self._entries.items()):
+                if entry.get('expires', 0) <= now:
+                    del self._entries[key]
+                    self._dirty = True
+        return self._entries
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or entry['expires'] <= time.time():
+            return default
+        return entry['value']
+
+    def set(self, key, value, ttl, **metadata):
+        entry = dict(metadata)
+        entry.update(value=value, expires=time.time() + float(ttl))
+        self.entries[key] = entry
+        self._dirty = True
+
+    def remove(self, match=None):
+        """Removes every entry for which match(entry) is true, or every entry
+        if no match is given.  Returns the number of entries removed"""
+        keys = [
+            k for k, entry in self.entries.items()
+            if match is None or match(entry)]
+        for key in keys:
+            del self.entries[key]
+        self._dirty = self._dirty or bool(keys)
+        return len(keys)
+
+    def save(self):
+        if self._dirty:
+            atomic_write(self.path, json.dumps(self.entries))
+            self._dirty = False
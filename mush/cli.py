@@ -1,10 +1,16 @@
 #! /usr/bin/python
+import difflib
+import json
 import os
 import prettytable
 import sys
+import tempfile
+import time
 from collections import OrderedDict
-from subprocess import call
-from mush import api
+from subprocess import call, Popen
+from mush import alias_index, api, cache, completion, engine, instrument
+from mush import forkserver, output_cache, runner
+from mush import agent as resident
 from mush.engine import config
 
 
@@ -49,6 +55,24 @@ class CLI(object):
                         's' if len(bad_flags) > 1 else '',
                         ", ".join(bad_flags)))
 
+        @classmethod
+        def number_flag(cls, flags, name, default=None, convert=float,
+                        positive=False):
+            """Returns the --<name>=<n> flag converted with convert, or
+            default if it isn't set.  Fails unless it is a number that is
+            at least 0 (above 0 if positive)."""
+            given = flags.get(name, default)
+            if given is None:
+                return None
+            try:
+                assert given is not True
+                value = convert(given)
+                assert value > 0 if positive else value >= 0
+            except (ValueError, AssertionError):
+                cls.fail("--{0} expects a {1}number, got '{2}'".format(
+                    name, "positive " if positive else "", given))
+            return value
+
         @classmethod
         def fail(cls, reason=None, help=True):
             cls.help()
@@ -76,12 +100,21 @@ class CLI(object):
                 pass
         return cmds
 
+    @classmethod
+    def _completion_commands(cls):
+        """Returns each command's flags, and the global flags as '-'"""
+        commands = dict(
+            (name.replace('_', '-'), list(getattr(cls, name)._known_flags))
+            for name in cls._command_names(python_names=True))
+        commands['-'] = ['help', 'profile']
+        return commands
+
     @classmethod
     def run(cls, args):
         # Get rid of the cmd
         args.remove(args[0])
         data_store = None
-        known_aliases = []
+        known_aliases = alias_index.AliasIndex([])
 
         if len(args) > 0 and args[0] != 'generate-config':
             failmsg = config.check()
@@ -89,12 +122,20 @@ class CLI(object):
                 print failmsg
                 print "Please run mush generate-config --help for more info"
                 exit(1)
-            data_store = api.data_store()
-            known_aliases = data_store.available_aliases()
+            # The agent command manages its own datastore
+            if args[0] != 'agent':
+                with instrument.timed('datastore.load'):
+                    data_store = resident.data_store() or api.data_store()
+                    known_aliases = alias_index.for_data_store(data_store)
+                with instrument.timed('completion.refresh'):
+                    completion.refresh(
+                        known_aliases.aliases, cls._completion_commands())
 
         mush_command = None
         client_command = None
         aliases = []
+        # Aliases added by a selector, rather than named
+        selected_aliases = set()
         flags = {}
 
         def quit_with_main_help(msg=None):
@@ -108,12 +149,13 @@ class CLI(object):
 
         # Parse out the aliases, mush command and flags from the client
         # command / client command args
+        command_names = set(cls._command_names())
         while args:
             arg = args[0]
             args.remove(arg)
 
             # Grab any mush command.  Die if more than one is found.
-            if arg in cls._command_names():
+            if arg in command_names:
                 if arg in known_aliases:
                     quit_with_main_help(
                         "Your alias '{0}' collides with a mush command by the "
@@ -125,7 +167,10 @@ class CLI(object):
                 continue
 
             if arg in known_aliases:
-                aliases.append(arg)
+                # Named again after a selector chose it, it runs only once
+                if arg not in selected_aliases:
+                    aliases.append(arg)
+                selected_aliases.discard(arg)
                 continue
 
             # Parse flags
@@ -137,24 +182,57 @@ class CLI(object):
                 flags[arg] = val
                 continue
 
+            # Expand alias selectors (@tag, globs and re:<regex>).  A glob
+            # that matches no alias is taken to be the client command.
+            if alias_index.is_selector(arg):
+                with instrument.timed('aliases.select', selector=arg):
+                    try:
+                        selected = known_aliases.select(arg)
+                    except alias_index.SelectorError as exception:
+                        quit_with_main_help(str(exception))
+                if selected:
+                    chosen = set(aliases)
+                    selected = [a for a in selected if a not in chosen]
+                    aliases.extend(selected)
+                    selected_aliases.update(selected)
+                    continue
+                if arg.startswith(alias_index.TAG_PREFIX) or \
+                        arg.startswith(alias_index.REGEX_PREFIX):
+                    quit_with_main_help(
+                        "'{0}' did not match any aliases".format(arg))
+
             # if we hit a non-alias, non-flag, assume it's the
             # start of the client command and stop the loop
             # We'll put the client command back in args later
             client_command = arg
             break
 
+        # --profile applies to mush itself rather than to any one command
+        profile = flags.pop('profile', None)
+        if profile:
+            instrument.enable(None if profile is True else profile)
+        elif not instrument.enabled():
+            instrument.disable()
+
         if client_command and not mush_command:
             # Issue the 'call' mush command by default
             args.insert(0, client_command)
             mush_command = "call"
             print "{}".format(" ".join(args))
+        elif client_command:
+            # A mush command's own arguments
+            args.insert(0, client_command)
         elif not client_command and not mush_command:
             # If no mush command is set by this point, then no previous rule
             # to set one applied, and a mush command was not provided.
             # Call help for the user.
             args, flags, mush_command = [], {}, "help"
 
-        cls._dispatch(mush_command, data_store, aliases, args, flags)
+        try:
+            with instrument.timed('command', command=mush_command):
+                cls._dispatch(mush_command, data_store, aliases, args, flags)
+        finally:
+            instrument.report()
 
     @classmethod
     def _dispatch(cls, cmd, data_store, aliases, args, flags):
@@ -193,6 +271,16 @@ class CLI(object):
                 "{0}mush <alias(es)> [--flags] <client> "
                 "[client command passthrough]\n"
                 .format(spacer))
+            helplines.append("{0}Selecting aliases:".format(spacer))
+            helplines.append(
+                "{0}Anywhere an alias is accepted, @<tag>, a glob (dfw-*) or "
+                "re:<regex> selects\n{0}every matching alias.  Tags come "
+                "from each alias' MUSH_TAGS variable.\n".format(spacer))
+            helplines.append("{0}Global flags:".format(spacer))
+            helplines.append(
+                "{0}--profile[=table|json|chrome]\n{1}Report how long each "
+                "phase of the run took, on stderr (or set MUSH_PROFILE)\n"
+                .format(spacer, spacer * 2))
             helplines.append("{0}Mush commands:".format(spacer))
             helplines.append(
                 "{0}mush <command> [alias(es)] [--flags] <client> "
@@ -230,29 +318,63 @@ class CLI(object):
                         (By default, those keys are not show)
         --keys-only     Only display keys
         --detail=<keys> Display only the keys specififed, and their values
+        --format=<fmt>  Machine readable output, written one alias at a time
+                        as soon as each is resolved:
+                        ndjson  One JSON object per line per alias, with
+                                'alias' and 'variables' (or 'keys' with
+                                --keys-only)
+                        json    A single JSON object of alias to variables
+                                (or to a list of keys with --keys-only)
+                        env0    For each alias, a record holding the alias,
+                                then a KEY=VALUE (or KEY) record for each
+                                variable, then an empty record.  Every
+                                record ends with a NUL character.
+        --no-secrets    Show values exactly as stored, without resolving
+                        any secrets in them
         """
         _known_flags = [
             'show-blanks', 'detail', 'keys-only', 'exportable', 'table',
-            'config-format', 'all-aliases']
+            'config-format', 'all-aliases', 'format', 'no-secrets']
+        _formats = ['ndjson', 'json', 'env0']
 
         @classmethod
         def target_keys(cls, flags, env_vars):
             """ Builds the list of keys that wil be used by the
-            print/formatting functions"""
-
-            if not flags.get('show-blanks'):
-                env_vars = OrderedDict(
-                    (k, v) for k, v in env_vars.iteritems() if v)
+            print/formatting functions.  Only the values that are shown
+            are read, so secrets in a LazyEnvironment that aren't shown are
+            never resolved."""
 
             if flags.get('detail'):
                 keys = flags.get('detail').split(',')
-                env_vars = {k: v for k, v in env_vars.items() if k in keys}
+                env_vars = OrderedDict(
+                    (k, env_vars[k]) for k in env_vars if k in keys)
 
             if flags.get('keys-only'):
-                env_vars = {k: '' for k in env_vars.keys()}
+                # A secret is never stored blank, so needn't be resolved to
+                # tell whether it is
+                peek = getattr(env_vars, 'peek', env_vars.get)
+                return OrderedDict(
+                    (k, '') for k in env_vars
+                    if flags.get('show-blanks') or peek(k))
+
+            if not flags.get('show-blanks'):
+                env_vars = OrderedDict(
+                    (k, v) for k, v in env_vars.iteritems() if v)
 
             return env_vars
 
+        @classmethod
+        def _resolve_secrets(cls, flags):
+            """Returns how the environments shown should be resolved.
+            --detail needn't be lazy, since only the detailed keys are
+            asked for, and resolving those together lets plugins overlap
+            them."""
+            if flags.get('no-secrets'):
+                return False
+            if flags.get('keys-only'):
+                return 'lazy'
+            return True
+
         @classmethod
         def exportable(cls, alias, env_vars):
             print "\n", "#", alias.upper()
@@ -280,6 +402,45 @@ class CLI(object):
             print "\n", alias.upper()
             print p
 
+        @classmethod
+        def _record(cls, flags, env_vars):
+            if flags.get('keys-only'):
+                return list(env_vars)
+            # Datastores' environments are mappings, but not always dicts,
+            # which is all the JSON encoder takes
+            return OrderedDict(env_vars.iteritems())
+
+        @classmethod
+        def stream(cls, fmt, environments, flags, out=None):
+            """Writes every (alias, env_vars) in environments to out as soon
+            as it is produced, in the machine readable format fmt"""
+            out = out or sys.stdout
+            dumps = json.JSONEncoder(separators=(',', ':')).encode
+            if fmt == 'json':
+                out.write('{')
+            for i, (alias, env_vars) in enumerate(environments):
+                env_vars = cls.target_keys(flags, env_vars)
+                if fmt == 'ndjson':
+                    out.write(dumps(OrderedDict((
+                        ('alias', alias),
+                        ('keys' if flags.get('keys-only') else 'variables',
+                         cls._record(flags, env_vars))))) + '\n')
+                elif fmt == 'json':
+                    out.write('{0}{1}:{2}'.format(
+                        ',' if i else '', dumps(alias),
+                        dumps(cls._record(flags, env_vars))))
+                else:
+                    out.write(alias + '\0')
+                    for k, v in env_vars.iteritems():
+                        out.write(
+                            k + '\0' if flags.get('keys-only')
+                            else '{0}={1}\0'.format(k, v))
+                    out.write('\0')
+                out.flush()
+            if fmt == 'json':
+                out.write('}\n')
+                out.flush()
+
         @classmethod
         def _call(cls, data_store, aliases, args, flags):
 
@@ -288,10 +449,22 @@ class CLI(object):
             else:
                 cls.check_aliases(aliases)
 
+            fmt = flags.get('format')
+            if fmt and fmt not in cls._formats:
+                cls.fail("--format must be one of {0}".format(
+                    ", ".join(cls._formats)))
+            keys = None
+            if flags.get('detail'):
+                keys = flags.get('detail').split(',')
+            environments = data_store.environment_variables_many(
+                aliases, resolve_secrets=cls._resolve_secrets(flags),
+                keys=keys)
+            if fmt:
+                return cls.stream(fmt, environments, flags)
+
             print aliases
-            for alias in aliases:
-                env_vars = cls.target_keys(
-                    flags, data_store.environment_variables(alias))
+            for alias, env_vars in environments:
+                env_vars = cls.target_keys(flags, env_vars)
 
                 # TODO: Make this call pluggable so that more print options
                 #       can be added later.
@@ -348,19 +521,204 @@ class CLI(object):
                         to the system's version of /dev/null
         --show-alias:   Prints the alias used before making the client call.
                         Useful when making calls to multiple aliases.
+        --parallel=<n>: Run the client command for up to <n> aliases at a
+                        time.  Output is buffered per alias and printed in
+                        the order the aliases were given, followed by a
+                        summary of exit codes and wall times on stderr.
+                        Exits non-zero if any alias' command failed.
+        --prefix-output:
+                        With --parallel, stream output as it is produced
+                        instead of buffering it, prefixing every line with
+                        the alias it came from.
+        --exec:         Only for a single alias.  Replace mush with the
+                        client command (no intermediate shell), passing
+                        its arguments through exactly as given.  Shell
+                        syntax in the arguments is not interpreted.
+                        Set 'exec=true' in the [mush] config section to
+                        do this by default for single alias calls.
+                        Can't be used with --parallel.
+        --cache-ttl=<s>:
+                        Reuse the output of an earlier identical call (same
+                        alias, environment and client command) made in the
+                        last <s> seconds, instead of running the client
+                        command again.  Only commands listed in the
+                        [output_cache] config section are ever cached.
         """
-        _known_flags = ['show-alias', 'no-stderr']
+        _known_flags = [
+            'show-alias', 'no-stderr', 'parallel', 'prefix-output', 'exec',
+            'cache-ttl']
+
+        @classmethod
+        def _environment(cls, user_env):
+            with instrument.timed('environment.copy'):
+                env = os.environ.copy()
+                env.update(user_env)
+            return env
 
         @classmethod
-        def _dispatch_to_shell(cls, cmd, data_store, alias, args, flags):
+        def _shell_command(cls, cmd, args):
+            return "{} {}".format(cmd, " ".join(args))
+
+        @classmethod
+        def _client(cls, cmd, args):
+            """Returns (command, popen) to run the client command with: its
+            argv and its fork server's popen if the [forkserver] config
+            section has one for it, or a shell command and Popen.  Commands
+            using shell syntax always go through the shell, so they behave
+            the same whether or not they have a fork server."""
+            server = None
+            if not runner.shell_syntax([cmd] + list(args)):
+                server = forkserver.server(cmd)
+            if server:
+                return [cmd] + list(args), server.popen
+            return cls._shell_command(cmd, args), Popen
+
+        @classmethod
+        def _dispatch_to_shell(
+                cls, cmd, data_store, alias, args, flags, user_env=None):
             stderr_out = \
                 open(os.devnull, 'w') if flags.get('no-stderr') else sys.stderr
-            env = os.environ.copy()
-            user_env = data_store.environment_variables(alias)
-            env.update(user_env)
-            cmd = "{} {}".format(cmd, " ".join(args))
-            call(
-                cmd, stdout=sys.stdout, stderr=stderr_out, shell=True, env=env)
+            if user_env is None:
+                user_env = data_store.environment_variables(alias)
+            env = cls._environment(user_env)
+            command, popen = cls._client(cmd, args)
+            sys.stdout.flush()
+            with instrument.timed('client', alias=alias):
+                return popen(
+                    command, stdout=sys.stdout, stderr=stderr_out,
+                    shell=isinstance(command, basestring), env=env).wait()
+
+        @classmethod
+        def _output_cache(cls, cmd, args, flags):
+            """Returns the OutputCache and the TTL to cache this call's
+            output with, or (None, None) if it shouldn't be cached"""
+            if not flags.get('cache-ttl'):
+                return None, None
+            ttl = cls.number_flag(flags, 'cache-ttl', positive=True)
+            if not output_cache.allowed([cmd] + list(args)):
+                print >> sys.stderr, (
+                    "Not caching the output of '{0}': it is not one of the "
+                    "commands in the [output_cache] section of the mush "
+                    "config".format(cmd))
+                return None, None
+            return output_cache.from_config(), ttl
+
+        @classmethod
+        def _cached_result(cls, cache, key, alias):
+            """Returns a Result for alias from the output cache, or None"""
+            with instrument.timed('output_cache.get', alias=alias):
+                hit = cache.get(key)
+            if hit is None:
+                return None
+            result = runner.Result(alias)
+            result.stdout, result.returncode = hit
+            result.duration = 0.0
+            result.cached = True
+            return result
+
+        @classmethod
+        def _store_result(cls, cache, key, result, ttl):
+            if result.returncode == 0 or output_cache.cache_failures():
+                with instrument.timed('output_cache.put', alias=result.alias):
+                    cache.put(key, result.stdout, result.returncode, ttl)
+
+        @classmethod
+        def _dispatch_cached(
+                cls, cmd, alias, args, flags, user_env, cache, ttl):
+            """Prints the cached output of the client command for alias, or
+            runs it, prints its output and caches it"""
+            key = cache.key(alias, user_env, [cmd] + list(args))
+            result = cls._cached_result(cache, key, alias)
+            if result is None:
+                command, popen = cls._client(cmd, args)
+                result = runner.run_captured(
+                    command, alias, cls._environment(user_env), popen=popen)
+                if not flags.get('no-stderr'):
+                    sys.stderr.write(result.stderr)
+                    sys.stderr.flush()
+                cls._store_result(cache, key, result, ttl)
+            sys.stdout.write(result.stdout)
+            sys.stdout.flush()
+            return result.returncode
+
+        @classmethod
+        def _dispatch_parallel(cls, cmd, data_store, aliases, args, flags):
+            if flags.get('parallel') is True:
+                workers = len(aliases)
+            else:
+                workers = cls.number_flag(
+                    flags, 'parallel', convert=int, positive=True)
+
+            # Environments (and any secrets in them) are resolved up front,
+            # since access_secret plugins may prompt.
+            user_envs = list(data_store.environment_variables_many(aliases))
+            jobs = [
+                (alias, cls._environment(user_env))
+                for alias, user_env in user_envs]
+
+            cache, ttl = cls._output_cache(cmd, args, flags)
+            keys = dict()
+            cached = dict()
+            if cache:
+                for alias, user_env in user_envs:
+                    keys[alias] = cache.key(
+                        alias, user_env, [cmd] + list(args))
+                    result = cls._cached_result(cache, keys[alias], alias)
+                    if result is not None:
+                        cached[alias] = result
+
+            def flush(result):
+                if flags.get('show-alias'):
+                    print "### {0} ###".format(result.alias)
+                sys.stdout.write(result.stdout)
+                sys.stdout.flush()
+                if not flags.get('no-stderr'):
+                    sys.stderr.write(result.stderr)
+                    sys.stderr.flush()
+
+            prefix_output = bool(flags.get('prefix-output'))
+            command, popen = cls._client(cmd, args)
+            results = runner.run_parallel(
+                command, jobs, workers, popen=popen,
+                on_result=None if prefix_output else flush,
+                prefix_output=prefix_output,
+                stderr=None if flags.get('no-stderr') else sys.stderr,
+                cached=cached)
+            if cache:
+                for result in results:
+                    if not result.cached:
+                        cls._store_result(
+                            cache, keys[result.alias], result, ttl)
+            cls.summary(results)
+            if any(r.returncode for r in results):
+                exit(1)
+
+        @classmethod
+        def _exec(cls, cmd, alias, args, flags, user_env):
+            """Replaces this process with the client command"""
+            env = cls._environment(user_env)
+            # Nothing after exec runs, so report and flush now
+            instrument.report()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if flags.get('no-stderr'):
+                os.dup2(os.open(os.devnull, os.O_WRONLY), 2)
+            try:
+                os.execvpe(cmd, [cmd] + list(args), env)
+            except OSError as exception:
+                cls.fail("Unable to run '{0}': {1}".format(
+                    cmd, exception.strerror))
+
+        @classmethod
+        def summary(cls, results):
+            p = prettytable.PrettyTable(
+                field_names=["Alias", "Exit Code", "Wall Time (s)"])
+            p.align["Alias"] = "l"
+            for r in results:
+                p.add_row((
+                    r.alias, r.returncode,
+                    "cached" if r.cached else "{0:.3f}".format(r.duration)))
+            print >> sys.stderr, p
 
         @classmethod
         def _call(cls, data_store, aliases, args, flags):
@@ -369,12 +727,445 @@ class CLI(object):
             cmd = args[0]
             args.remove(cmd)
 
-            for alias in aliases:
+            if flags.get('parallel') and flags.get('exec'):
+                cls.fail('--exec and --parallel cannot be used together')
+            if flags.get('parallel'):
+                return cls._dispatch_parallel(
+                    cmd, data_store, aliases, args, flags)
+
+            if flags.get('exec') and len(aliases) > 1:
+                cls.fail('--exec can only be used with a single alias')
+            if flags.get('exec') and flags.get('cache-ttl'):
+                cls.fail('--exec and --cache-ttl cannot be used together')
+            cache, ttl = cls._output_cache(cmd, args, flags)
+            if len(aliases) == 1 and not cache and (
+                    flags.get('exec') or config.get_option(
+                        'mush', 'exec', 'false').lower() == 'true'):
+                alias = aliases[0]
+                if flags.get('show-alias'):
+                    print "### {0} ###".format(alias)
+                cls._exec(
+                    cmd, alias, args, flags,
+                    data_store.environment_variables(alias))
+
+            for alias, user_env in \
+                    data_store.environment_variables_many(aliases):
                 if flags.get('show-alias'):
                     print "### {0} ###".format(alias)
+                if cache:
+                    cls._dispatch_cached(
+                        cmd, alias, args, flags, user_env, cache, ttl)
+                    continue
                 cls._dispatch_to_shell(
                     cmd, data_store, alias, args,
-                    {'no-stderr': flags.get('no-stderr')})
+                    {'no-stderr': flags.get('no-stderr')}, user_env=user_env)
+
+    class watch(_command):
+        """Calls client command for every alias listed again and again, like
+        watch(1), printing only the lines of each alias' output that changed
+        since its previous run
+
+            mush <alias(es)> watch [--flags] <client command>
+
+        Each alias' environment (and any secrets in it) is resolved once,
+        and only resolved again once it is older than the refresh time.
+        The client command runs for every alias at the same time.
+
+        --interval=<s>  Seconds between runs.  Defaults to 2.
+        --count=<n>     Stop after <n> runs.  By default runs until
+                        interrupted.
+        --refresh=<s>   Resolve environments again once they are <s>
+                        seconds old (0 for never).  Defaults to 'refresh'
+                        in the [watch] config section, or 300.
+        --full          Print all of every run's output, not only what
+                        changed.
+        --no-stderr     Discard the client command's stderr.
+        """
+        _known_flags = ['interval', 'count', 'refresh', 'full', 'no-stderr']
+
+        @classmethod
+        def _resolve(cls, data_store, aliases):
+            """Returns [(alias, environment)], with secrets resolved afresh
+            rather than remembered by the plugins from earlier runs"""
+            loaded = engine.registry.plugins('access_secret') or {}
+            for plugin in loaded.values():
+                plugin.reset()
+            with instrument.timed('watch.resolve'):
+                return [
+                    (alias, CLI.call._environment(user_env))
+                    for alias, user_env in
+                    data_store.environment_variables_many(aliases)]
+
+        @classmethod
+        def changes(cls, previous, current):
+            """Returns the lines of current that aren't in previous, as
+            '+ line', and those of previous that are gone, as '- line'"""
+            if previous is None:
+                return current.splitlines(True)
+            return [
+                line[0] + ' ' + line[1:] for line in difflib.unified_diff(
+                    previous.splitlines(True), current.splitlines(True), n=0)
+                if line[:1] in '+-' and line[:3] not in ('+++', '---')]
+
+        @classmethod
+        def show(cls, result, previous, flags):
+            """Prints what changed in result since previous, the Result of
+            the same alias' previous run (or None)"""
+            last_stdout, last_stderr, last_code = previous or (None, '', 0)
+            if flags.get('full'):
+                last_stdout = None
+            stdout = cls.changes(last_stdout, result.stdout)
+            stderr = [] if flags.get('no-stderr') or \
+                result.stderr == last_stderr else [result.stderr]
+            code = result.returncode != (
+                last_code if previous else 0)
+            if not (stdout or stderr or code):
+                return
+            print "### {0}{1} ###".format(
+                result.alias, " (exit code {0})".format(
+                    result.returncode) if code else "")
+            for line in stdout:
+                sys.stdout.write(line if line.endswith('\n') else line + '\n')
+            sys.stdout.flush()
+            for text in stderr:
+                sys.stderr.write(text)
+                sys.stderr.flush()
+
+        @classmethod
+        def _call(cls, data_store, aliases, args, flags):
+            cls.check_aliases(aliases)
+            if not args:
+                cls.fail('No client command entered')
+            interval = cls.number_flag(flags, 'interval', 2)
+            count = cls.number_flag(flags, 'count', 0, int)
+            refresh = cls.number_flag(flags, 'refresh', config.get_option(
+                'watch', 'refresh', 300))
+            args = list(args)
+            command, popen = CLI.call._client(args[0], args[1:])
+
+            jobs = cls._resolve(data_store, aliases)
+            resolved = time.time()
+            previous = dict()
+            runs = 0
+            try:
+                while True:
+                    start = time.time()
+                    if refresh and start - resolved >= refresh:
+                        jobs = cls._resolve(data_store, aliases)
+                        resolved = start
+                    print "Every {0}s: {1}    {2}".format(
+                        interval, " ".join(args), time.ctime())
+                    sys.stdout.flush()
+                    results = runner.run_parallel(
+                        command, jobs, len(jobs), popen=popen)
+                    for result in results:
+                        cls.show(result, previous.get(result.alias), flags)
+                        previous[result.alias] = (
+                            result.stdout, result.stderr, result.returncode)
+                    runs += 1
+                    if count and runs >= count:
+                        return
+                    # Runs start every interval, however long each takes
+                    time.sleep(max(0, start + interval - time.time()))
+            except KeyboardInterrupt:
+                print
+
+    class batch(_command):
+        """Runs many (alias, client command) jobs, read from a file (or
+        stdin), loading the datastore and resolving each alias' environment
+        only once:
+
+            mush batch [--flags] [<file>]
+
+        Each line of the file is a job:
+
+            <alias> <client command>
+            {"alias": ..., "argv": [...], "timeout": ..., "retries": ...}
+
+        A plain line's client command is run through the shell, like
+        'mush call' would.  A JSON line runs its argv (or "command", through
+        the shell) and may override --timeout and --retries.  Aliases may be
+        selectors (@tag, globs, re:<regex>), which run the job for every
+        alias they match.  Blank lines and lines starting with # are
+        skipped.
+
+        A JSON result is printed for every job as soon as it finishes, with
+        its alias, argv, exit_code, duration, attempts, timed_out, and the
+        paths of the files holding its stdout and stderr.
+
+        <file>:             The jobs file, or - for stdin (the default).
+        --workers=<n>       Run up to <n> jobs at a time.  Defaults to 8.
+        --per-alias=<n>     Run up to <n> jobs for the same alias at a time.
+                            Defaults to no limit.
+        --timeout=<s>       Kill a job after <s> seconds.
+        --retries=<n>       Run a failed job again up to <n> times.
+        --output-dir=<dir>  Where job output is written.  Defaults to a new
+                            temporary directory.
+        """
+        _known_flags = [
+            'workers', 'per-alias', 'timeout', 'retries', 'output-dir']
+
+        @classmethod
+        def _parse(cls, number, line, index):
+            """Returns (aliases, command, argv, overrides) for a job line"""
+            if line.startswith('{'):
+                try:
+                    job = json.loads(line)
+                    selector = str(job['alias'])
+                    if 'argv' in job:
+                        argv = [a.encode('utf-8') for a in job['argv']]
+                        command = argv
+                    else:
+                        command = job['command'].encode('utf-8')
+                        argv = None
+                except (ValueError, KeyError, TypeError,
+                        AttributeError) as exception:
+                    cls.fail("Job {0} is not a valid job: {1}".format(
+                        number, exception))
+                overrides = dict(
+                    (k, job[k]) for k in ('timeout', 'retries') if k in job)
+            else:
+                parts = line.split(None, 1)
+                if len(parts) != 2:
+                    cls.fail("Job {0} has no client command".format(number))
+                selector, command = parts
+                argv = None
+                overrides = dict()
+            if argv is None:
+                # What Popen runs for a command string
+                argv = ['/bin/sh', '-c', command]
+
+            if selector in index:
+                aliases = [selector]
+            elif alias_index.is_selector(selector):
+                try:
+                    aliases = index.select(selector)
+                except alias_index.SelectorError as exception:
+                    cls.fail("Job {0}: {1}".format(number, exception))
+            else:
+                aliases = []
+            if not aliases:
+                cls.fail("Job {0}: '{1}' is not a known alias".format(
+                    number, selector))
+            return aliases, command, argv, overrides
+
+        @classmethod
+        def _call(cls, data_store, aliases, args, flags):
+            workers = cls.number_flag(flags, 'workers', 8, int)
+            per_alias = cls.number_flag(flags, 'per-alias', None, int)
+            timeout = cls.number_flag(flags, 'timeout')
+            retries = cls.number_flag(flags, 'retries', 0, int)
+            output_dir = flags.get('output-dir')
+            if output_dir:
+                output_dir = cache.ensure_dir(
+                    os.path.abspath(os.path.expanduser(output_dir)))
+            else:
+                output_dir = tempfile.mkdtemp(prefix='mush-batch-')
+
+            if len(args) > 1:
+                print cls.help()
+                cls.fail("Expected one jobs file (flags go before it), "
+                         "got: {0}".format(" ".join(args)))
+            path = args[0] if args else '-'
+            try:
+                jobs_file = sys.stdin if path == '-' else open(path)
+            except IOError as exception:
+                cls.fail("Unable to read the jobs file: {0}".format(
+                    exception))
+            index = alias_index.for_data_store(data_store)
+            jobs = []
+            argvs = dict()
+            with jobs_file:
+                for number, line in enumerate(jobs_file, 1):
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    job_aliases, command, argv, overrides = cls._parse(
+                        number, line, index)
+                    for alias in job_aliases:
+                        n = len(jobs)
+                        argvs[n] = argv
+                        jobs.append(runner.Job(
+                            n, alias, command,
+                            os.path.join(output_dir, '{0}.stdout'.format(n)),
+                            os.path.join(output_dir, '{0}.stderr'.format(n)),
+                            timeout=overrides.get('timeout', timeout),
+                            retries=int(overrides.get('retries', retries))))
+
+            # Every environment (and any secrets in it) is resolved once,
+            # up front, since access_secret plugins may prompt
+            unique = list(OrderedDict((job.alias, None) for job in jobs))
+            environments = dict(
+                (alias, CLI.call._environment(user_env))
+                for alias, user_env in
+                data_store.environment_variables_many(unique))
+
+            def report(job, result):
+                print json.dumps(OrderedDict((
+                    ('job', job.number),
+                    ('alias', job.alias),
+                    ('argv', argvs[job.number]),
+                    ('exit_code', result.returncode),
+                    ('duration', round(result.duration or 0, 3)),
+                    ('attempts', result.attempts),
+                    ('timed_out', result.timed_out),
+                    ('stdout', job.stdout_path),
+                    ('stderr', job.stderr_path))))
+                sys.stdout.flush()
+
+            results = runner.run_jobs(
+                jobs, environments, workers or 1, per_alias, report)
+            failed = len([r for r in results if r.returncode])
+            print >> sys.stderr, (
+                "{0} jobs, {1} failed.  Output is in {2}".format(
+                    len(results), failed, output_dir))
+            if failed:
+                exit(1)
+
+    class secrets(_command):
+        """Manage the cache of values resolved by access_secret plugins.
+        Only plugins with a 'cache_ttl' (in seconds) set in their config
+        section have their values cached.
+
+        <alias(es)>:    The aliases to act on.
+        --all-aliases   Act on every alias in the datastore.
+        --flush         Remove the cached secrets for the aliases (or for
+                        every alias, if none are given).
+        --warm          Resolve the secrets for the aliases now, replacing
+                        anything already cached for them.
+        """
+        _known_flags = ['all-aliases', 'flush', 'warm']
+
+        @classmethod
+        def _call(cls, data_store, aliases, args, flags):
+            if flags.get('all-aliases'):
+                aliases = data_store.available_aliases()
+            if not (flags.get('flush') or flags.get('warm')):
+                print cls.help()
+                cls.fail('One of --flush or --warm is required')
+
+            secret_cache = engine.secret_cache()
+            if flags.get('flush') and not aliases:
+                removed = secret_cache.flush()
+                resident.flush()
+                cls.finish("Flushed {0} cached secrets".format(removed))
+
+            cls.check_aliases(aliases)
+            removed = secret_cache.flush(aliases)
+            resident.flush(aliases)
+            if flags.get('flush'):
+                print "Flushed {0} cached secrets".format(removed)
+            if flags.get('warm'):
+                list(data_store.environment_variables_many(aliases))
+                print "Warmed cached secrets for {0} aliases".format(
+                    len(aliases))
+
+    class completion(_command):
+        """Prints a bash or zsh completion script for mush, and builds the
+        index of aliases, commands and flags it completes from.  The
+        script reads the index directly, without starting mush, and later
+        mush runs keep the index up to date.
+
+        <shell>:        bash or zsh
+
+        To enable completion, add this to your ~/.bashrc or ~/.zshrc:
+            source <(mush completion bash)
+        """
+
+        @classmethod
+        def _call(cls, data_store, aliases, args, flags):
+            if len(args) != 1 or args[0] not in completion.SHELLS:
+                print cls.help()
+                cls.fail('Choose one of: {0}'.format(
+                    ", ".join(completion.SHELLS)))
+            path = completion.refresh(
+                data_store.available_aliases(), CLI._completion_commands(),
+                force=True)
+            sys.stdout.write(completion.script(args[0], path))
+
+    class agent(_command):
+        """Runs a resident mush agent, similar to ssh-agent.  The agent keeps
+        the config, plugins, datastore and resolved environments in memory,
+        and later mush calls ask it for environments over a Unix socket
+        instead of loading everything again.  It reloads whatever depends on
+        the config or datastore files when they change.  Set MUSH_NO_AGENT
+        to make a mush call ignore a running agent.
+
+        The socket is <cache_dir>/agent.sock, unless set with 'socket' in
+        the [agent] config section or the MUSH_AGENT_SOCK variable.
+        Resolved environments are kept for 'environment_ttl' seconds (in
+        the [agent] section, 300 by default).
+
+        --start         Start the agent in the background.
+        --foreground    With --start, run the agent in the foreground.
+        --stop          Stop the running agent.
+        --status        Show whether an agent is running.
+        """
+        _known_flags = ['start', 'stop', 'status', 'foreground']
+
+        @classmethod
+        def _call(cls, data_store, aliases, args, flags):
+            try:
+                if flags.get('start') and flags.get('foreground'):
+                    print "mush agent listening on {0}".format(
+                        resident.socket_path())
+                    sys.stdout.flush()
+                    resident.start(foreground=True)
+                    cls.finish("mush agent stopped")
+                if flags.get('start'):
+                    cls.finish("mush agent (pid {0}) listening on {1}".format(
+                        resident.start(), resident.socket_path()))
+                if flags.get('stop'):
+                    cls.finish("Stopped mush agent (pid {0})".format(
+                        resident.stop()))
+            except resident.AgentError as exception:
+                cls.fail(str(exception))
+            if flags.get('status'):
+                status = resident.status()
+                if status is None:
+                    cls.fail("No mush agent is listening on {0}".format(
+                        resident.socket_path()))
+                cls.finish(
+                    "mush agent (pid {0}) listening on {1}, using {2}".format(
+                        status['pid'], resident.socket_path(),
+                        status['config']))
+            print cls.help()
+            cls.fail('One of --start, --stop or --status is required')
+
+    class import_datastore(_command):
+        """Copies every alias from one datastore plugin into another, e.g.
+        from csv or supernova into sqlite.  Values are copied exactly as
+        stored: secrets are not resolved.  Both plugins use their own
+        sections of the mush config.
+
+        --from=<keyname>    Datastore plugin to read from.
+        --to=<keyname>      Datastore plugin to write to (it must support
+                            importing).  Defaults to sqlite.
+        --merge             Keep the aliases already in the target datastore
+                            instead of replacing them all.
+        """
+        _known_flags = ['from', 'to', 'merge']
+
+        @classmethod
+        def _call(cls, data_store, aliases, args, flags):
+            source_keyname = flags.get('from')
+            target_keyname = flags.get('to') or 'sqlite'
+            if source_keyname in (None, True):
+                print cls.help()
+                cls.fail('--from=<keyname> is required')
+            source = api.data_store(keyname=source_keyname)
+            target = api.data_store(keyname=target_keyname)
+            if not hasattr(target, 'import_environments'):
+                cls.fail("The '{0}' datastore does not support importing"
+                         .format(target_keyname))
+            environments = (
+                (alias, list(env_vars.items())) for alias, env_vars in
+                source.environment_variables_many(
+                    source.available_aliases(), resolve_secrets=False))
+            count = target.import_environments(
+                environments, merge=bool(flags.get('merge')))
+            cls.finish("Imported {0} aliases from {1} into {2}".format(
+                count, source_keyname, target_keyname))
 
     class generate_config(_command):
         """
@@ -389,7 +1180,8 @@ class CLI(object):
 
         @classmethod
         def _call(cls, data_store, aliases, args, flags):
-            from mush.plugins.interfaces import registry
+            from mush.engine import registry
+            api.load_all()
 
             print cls.__doc__
             print '#BEGIN CONFIG'
@@ -0,0 +1,125 @@
+"""
+Shell completion for mush.
+
+Completing a word must not start Python, so everything completion needs is
+kept in a small index file in the cache directory, read by the completion
+script with awk.  Every line of the index is one of:
+
+    v <signature>           What the index was built from
+    c <command>             A mush command
+    f <command> <flag>      A flag of a mush command ('-' for global flags)
+    a <alias>               An alias
+
+Once 'mush completion' has created the index, every mush run that loads the
+datastore checks the signature line and rewrites the index if the config
+file, the aliases or mush's commands and flags have changed.
+"""
+import hashlib
+import os
+from mush import cache, engine
+
+SHELLS = ['bash', 'zsh']
+
+# Prints the completions for the word 'cur', given the earlier words in
+# 'prev'.  Flags are completed for the first mush command in prev, or for
+# 'call' if there isn't one.
+AWK_PROGRAM = r"""
+$1 == "c" {
+    commands[$2] = 1
+    if (cur !~ /^-/ && index($2, cur) == 1) print $2
+    next
+}
+$1 == "f" {
+    if (cmd == "") {
+        cmd = "call"
+        n = split(prev, p, " ")
+        for (i = 1; i <= n; i++) if (p[i] in commands) { cmd = p[i]; break }
+    }
+    if (cur ~ /^-/ && ($2 == cmd || $2 == "-") && index($3, cur) == 1)
+        print $3
+    next
+}
+$1 == "a" && cur !~ /^-/ && index($2, cur) == 1 { print $2 }
+"""
+
+BASH_SCRIPT = """# mush bash completion.  Load it with:
+#     source <(mush completion bash)
+_mush_complete() {
+    local index="${MUSH_COMPLETION_INDEX:-%(index)s}"
+    [ -r "$index" ] || return 0
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    local prev="${COMP_WORDS[*]:1:COMP_CWORD-1}"
+    COMPREPLY=($(awk -v cur="$cur" -v prev="$prev" '%(awk)s' "$index"))
+}
+complete -o default -F _mush_complete mush
+"""
+
+ZSH_SCRIPT = """# mush zsh completion.  Load it with:
+#     source <(mush completion zsh)
+_mush() {
+    local index="${MUSH_COMPLETION_INDEX:-%(index)s}"
+    [[ -r $index ]] || return 1
+    local -a matches
+    matches=(${(f)"$(awk -v cur="$PREFIX" -v prev="${words[2,CURRENT-1]}" \\
+        '%(awk)s' "$index")"})
+    (( ${#matches} )) && compadd -a matches || _files
+}
+compdef _mush mush
+"""
+
+
+def index_path():
+    return engine.config.cache_path('completion.index')
+
+
+def signature(aliases, commands):
+    """Identifies the aliases, the mush commands and flags, and the config
+    file the index is built from"""
+    digest = hashlib.sha1()
+    digest.update(repr(cache.file_signature(engine.config._cfgpath)))
+    for name in sorted(commands):
+        digest.update("\0{0}\0{1}".format(name, ",".join(commands[name])))
+    digest.update("\0".join(aliases))
+    return digest.hexdigest()
+
+
+def _current_signature(path):
+    try:
+        with open(path) as index_file:
+            kind, _, value = index_file.readline().strip().partition(' ')
+    except IOError:
+        return None
+    return value if kind == 'v' else None
+
+
+def write_index(path, aliases, commands, version):
+    lines = ["v " + version]
+    lines.extend("c " + name for name in sorted(commands) if name != '-')
+    for name in sorted(commands):
+        lines.extend("f {0} --{1}".format(name, f) for f in commands[name])
+    # Aliases with whitespace in them can't be completed as one word
+    lines.extend("a " + a for a in aliases if len(a.split()) == 1)
+    cache.atomic_write(path, "\n".join(lines) + "\n", mode=0o600)
+
+
+def refresh(aliases, commands, force=False):
+    """Rewrites the index if it exists (or force is set) and is out of
+    date.  commands maps each command name ('-' for global flags) to its
+    list of flags."""
+    path = index_path()
+    if not force and not os.path.exists(path):
+        return path
+    version = signature(aliases, commands)
+    if force or _current_signature(path) != version:
+        try:
+            write_index(path, aliases, commands, version)
+        except (IOError, OSError):
+            # Completion only gets staler, carry on without it
+            pass
+    return path
+
+
+def script(shell, path):
+    template = BASH_SCRIPT if shell == 'bash' else ZSH_SCRIPT
+    return template % {
+        'index': path, 'awk': AWK_PROGRAM.strip()}
@@ -1,5 +1,9 @@
 import os
+import sys
 import ConfigParser
+from collections import MutableMapping, OrderedDict
+from mush import instrument
+from mush.secret_cache import SecretCache
 
 
 class config(object):
@@ -8,7 +12,16 @@ class config(object):
     if os.path.exists(_localpath):
         _cfgpath = _localpath
     _config = ConfigParser.RawConfigParser()
-    _config.read(_cfgpath)
+    with instrument.timed('config.load'):
+        _config.read(_cfgpath)
+
+    @classmethod
+    def reload(cls):
+        """Re-reads the config file"""
+        _config = ConfigParser.RawConfigParser()
+        with instrument.timed('config.load'):
+            _config.read(cls._cfgpath)
+        cls._config = _config
 
     @classmethod
     def check(cls, append_failmsg=None):
@@ -25,10 +38,48 @@ class config(object):
     def get(cls, interface, keyname, key, defaults=None):
         try:
             return cls._config.get("{}.{}".format(interface, keyname), key)
-        except ConfigParser.NoSectionError:
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
             defaults = defaults or dict()
             return defaults.get(key)
 
+    @classmethod
+    def get_option(cls, section, key, default=None):
+        """Returns the value of key in section, or default if either is
+        missing"""
+        try:
+            return cls._config.get(section, key)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            return default
+
+    @classmethod
+    def enabled_keynames(cls, interface):
+        """Returns the keynames of the plugins the config enables for the
+        interface: any listed (comma separated) for it in the
+        'default_plugins' section, followed by any that have their own
+        [interface.keyname] section"""
+        default = cls.get_option('default_plugins', interface, '')
+        keynames = [k.strip() for k in default.split(',') if k.strip()]
+        for section in cls._config.sections():
+            section_interface, _, keyname = section.partition('.')
+            if section_interface == interface and keyname \
+                    and keyname not in keynames:
+                keynames.append(keyname)
+        return keynames
+
+    @classmethod
+    def cache_dir(cls):
+        """Directory mush keeps its caches in.  Defaults to a 'cache'
+        directory next to the config file, and can be set with 'cache_dir'
+        in the [mush] section"""
+        path = cls.get_option(
+            'mush', 'cache_dir',
+            os.path.join(os.path.dirname(cls._cfgpath), 'cache'))
+        return os.path.abspath(os.path.expanduser(path))
+
+    @classmethod
+    def cache_path(cls, *parts):
+        return os.path.join(cls.cache_dir(), *parts)
+
     @classmethod
     def get_default(cls, interface, key):
         """Returns the value of the key for the default implementation of the
@@ -44,6 +95,9 @@ class Registry(dict):
     def __init__(self):
         self['interfaces'] = list()
         self['plugins'] = dict()
+        # Set by the api when plugins are imported on demand.  Must provide
+        # keynames(interface_name) and load(interface_name, keyname).
+        self.manifest = None
 
     def interface(self, interface_name):
         return self.get('interfaces').get(interface_name)
@@ -57,26 +111,338 @@ class Registry(dict):
         return self.get('plugins')
 
     def plugin(self, interface_name, keyname):
-        return self.get('plugins').get(interface_name).get(keyname)
+        plugin = self.get('plugins').get(interface_name, dict()).get(keyname)
+        if plugin is None and self.manifest:
+            self.manifest.load(interface_name, keyname)
+            plugin = self.get('plugins').get(
+                interface_name, dict()).get(keyname)
+        return plugin
 
     def keynames(self, interface_name):
-        return self.get('plugins').get(interface_name).keys()
+        keynames = list(self.get('plugins').get(interface_name, dict()))
+        if self.manifest:
+            keynames.extend(
+                k for k in self.manifest.keynames(interface_name)
+                if k not in keynames)
+        return keynames
 
 # Stores all registered extensions in this module
 registry = Registry()
 
 
+_secret_cache = None
+
+
+def secret_cache(reload=False):
+    """Returns the SecretCache shared by every pipeline in this process.
+    With reload, anything it has already read from disk is discarded."""
+    global _secret_cache
+    if _secret_cache is None or reload:
+        _secret_cache = SecretCache(config.cache_path('secrets.json'))
+    return _secret_cache
+
+
+class PrefixDispatcher(object):
+    """Routes values to the enabled plugins of a pipeline interface by their
+    'magic_prefix'.  The prefixes are kept in a trie, so each value is only
+    looked at once, however many plugins are enabled, and each plugin is
+    only called with the variables whose values carry its prefix.
+
+    Enabled plugins without a 'magic_prefix' are transforms: they are
+    called with the whole environment, after the prefixed plugins.
+    Plugins are instantiated once, and reused for every environment."""
+
+    # Key of the plugin owning the prefix that ends at a trie node
+    _OWNER = None
+
+    def __init__(self, interface_name):
+        self.interface_name = interface_name
+        self.prefixed = []
+        self.transforms = []
+        self._trie = dict()
+        for keyname in config.enabled_keynames(interface_name):
+            # Plugins the manifest doesn't know of are looked for again
+            plugin = registry.plugin(interface_name, keyname)
+            if not plugin:
+                # Its values would silently pass through unresolved
+                print >> sys.stderr, (
+                    "{0} plugin '{1}' is enabled but unavailable, values "
+                    "it would handle are left as they are".format(
+                        interface_name, keyname))
+                continue
+            stage = _Stage(keyname, plugin)
+            prefix = plugin.cfg('magic_prefix')
+            if prefix:
+                self._add(prefix, stage)
+            else:
+                self.transforms.append(stage)
+        self.caching = any(
+            stage.ttl > 0 for stage in self.prefixed + self.transforms)
+
+    def _add(self, prefix, stage):
+        node = self._trie
+        for character in prefix:
+            node = node.setdefault(character, dict())
+        # When two plugins claim the same prefix, the first one enabled wins
+        if self._OWNER not in node:
+            node[self._OWNER] = stage
+            self.prefixed.append(stage)
+
+    def owner(self, value):
+        """Returns the stage owning the longest prefix of value, or None"""
+        node = self._trie
+        owner = None
+        for character in value:
+            node = node.get(character)
+            if node is None:
+                break
+            owner = node.get(self._OWNER, owner)
+        return owner
+
+    def route(self, environment_variables):
+        """Returns [(stage, {variable: value} of the variables it owns)], in
+        the order the stages were enabled"""
+        if not self._trie:
+            return []
+        trie = self._trie
+        routes = dict()
+        for k, v in environment_variables.iteritems():
+            if v and v[0] in trie:
+                stage = self.owner(v)
+                if stage is not None:
+                    routes.setdefault(stage, dict())[k] = v
+        return [(s, routes[s]) for s in self.prefixed if s in routes]
+
+    def _cached(self, alias, val, routes):
+        """Applies to val, and returns, the unexpired cached values of the
+        variables owned by plugins that cache what they resolve"""
+        if any(stage.ttl > 0 for stage in self.transforms):
+            candidates = val
+        else:
+            candidates = dict()
+            for stage, owned in routes:
+                if stage.ttl > 0:
+                    candidates.update(owned)
+        cached = secret_cache().lookup(alias, candidates)
+        val.update(cached)
+        return cached
+
+    def __call__(self, alias, val, raw):
+        """Resolves the values of val, the environment of alias.  raw is a
+        copy of the values as stored, only needed when caching."""
+        return self.many([(alias, val, raw)])[0]
+
+    def many(self, items):
+        """Resolves the environments in items, a list of (alias, val, raw)
+        as passed to __call__, and returns them in order.  Each plugin is
+        handed everything it owns in every environment at once, through
+        its call_many(), so it can resolve them concurrently."""
+        tags = dict(alias=items[0][0]) if len(items) == 1 else dict(
+            aliases=len(items))
+        owners = dict()
+        cached = []
+        for i, (alias, val, raw) in enumerate(items):
+            routes = self.route(val)
+            cached.append(
+                self._cached(alias, val, routes)
+                if alias and self.caching else dict())
+            for stage, owned in routes:
+                if cached[i]:
+                    owned = dict(
+                        (k, v) for k, v in owned.items()
+                        if k not in cached[i])
+                    if not owned:
+                        continue
+                owners.setdefault(stage, list()).append((i, owned))
+        for stage in self.prefixed:
+            if stage not in owners:
+                continue
+            # Plugins may resolve the values in place
+            before = [dict(variables) for j, variables in owners[stage]]
+            with instrument.timed(
+                    self.interface_name, plugin=stage.keyname, **tags):
+                resolved = stage.instance.call_many(
+                    [variables for j, variables in owners[stage]])
+            for (i, owned), previous, after in zip(
+                    owners[stage], before, resolved):
+                alias, val, raw = items[i]
+                stage.cache_resolved(alias, raw, previous, after, cached[i])
+                val.update(after)
+        vals = [item[1] for item in items]
+        for stage in self.transforms:
+            before = [dict(environment) for environment in vals]
+            with instrument.timed(
+                    self.interface_name, plugin=stage.keyname, **tags):
+                vals = stage.instance.call_many(vals)
+            for (alias, val, raw), previous, after, hits in zip(
+                    items, before, vals, cached):
+                stage.cache_resolved(alias, raw, previous, after, hits)
+        return vals
+
+
+class _Stage(object):
+    """An enabled plugin, its reused instance and its cache settings"""
+    __slots__ = ('keyname', 'plugin', 'instance', 'ttl')
+
+    def __init__(self, keyname, plugin):
+        self.keyname = keyname
+        self.plugin = plugin
+        self.instance = plugin()
+        self.ttl = float(plugin.cfg('cache_ttl') or 0)
+
+    def cache_resolved(self, alias, raw, before, after, cached):
+        if not alias or self.ttl <= 0:
+            return
+        for k, v in after.items():
+            if k in raw and k not in cached and v is not None \
+                    and v != before.get(k):
+                secret_cache().store(alias, k, raw[k], v, self.ttl)
+
+
+_dispatchers = dict()
+
+
+def dispatcher(interface_name):
+    """Returns the PrefixDispatcher for interface_name, built once for each
+    time the config is (re)loaded"""
+    key = (interface_name, id(config._config))
+    if key not in _dispatchers:
+        for stale in [k for k in _dispatchers if k[0] == interface_name]:
+            del _dispatchers[stale]
+        _dispatchers[key] = PrefixDispatcher(interface_name)
+    return _dispatchers[key]
+
+
+class LazyEnvironment(MutableMapping):
+    """The environment of alias, whose secrets are only resolved (by the
+    given dispatchers) when their values are first read.  Listing its keys
+    resolves nothing."""
+
+    def __init__(self, alias, stored, dispatchers, pending):
+        self.alias = alias
+        self._values = stored
+        self._dispatchers = dispatchers
+        # The variables whose values some plugin owns
+        self._pending = pending
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            self._resolve(key)
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._pending.discard(key)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        self._pending.discard(key)
+        del self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def peek(self, key, default=None):
+        """Returns the value of key without resolving it: as stored if it
+        hasn't been read yet"""
+        return self._values.get(key, default)
+
+    def _resolve(self, key):
+        val = {key: self._values[key]}
+        raw = dict(val)
+        for pipeline in self._dispatchers:
+            val = pipeline(self.alias, val, raw)
+        if any(d.caching for d in self._dispatchers):
+            secret_cache().save()
+        self._pending.discard(key)
+        self._values[key] = val[key]
+
+
+def _lazy(alias, val, dispatchers):
+    """Returns val as a LazyEnvironment, or as it is if it has no secrets"""
+    pending = set()
+    for pipeline in dispatchers:
+        for stage, owned in pipeline.route(val):
+            pending.update(owned)
+    if not pending:
+        return val
+    return LazyEnvironment(alias, val, dispatchers, pending)
+
+
+def _project(val, keys):
+    """Returns the variables of val named in keys, in val's order"""
+    return OrderedDict((k, val[k]) for k in val if k in keys)
+
+
+def resolve_environments(pipeline_interfaces, environments,
+                         keys=None, lazy=False):
+    """Passes environments, a list of (alias, environment_variables) as
+    stored, through the enabled plugins of each of the pipeline interfaces
+    in turn, and returns the resolved environment_variables in order.
+
+    With keys, only those variables are returned, and only their secrets
+    are resolved.  With lazy, LazyEnvironments are returned instead.
+    Plugins without a magic_prefix may need every variable, so when any
+    are enabled both are only applied to the fully resolved environments.
+    """
+    dispatchers = [dispatcher(i) for i in pipeline_interfaces]
+    if keys is not None:
+        keys = frozenset(keys)
+    if not any(d.transforms for d in dispatchers):
+        if keys is not None:
+            environments = [
+                (alias, _project(val, keys)) for alias, val in environments]
+            keys = None
+        if lazy:
+            return [
+                _lazy(alias, val, dispatchers) for alias, val in environments]
+    caching = any(d.caching for d in dispatchers)
+    items = [
+        (alias, val, dict(val) if caching else None)
+        for alias, val in environments]
+    for pipeline in dispatchers:
+        vals = pipeline.many(items) if items else []
+        items = [
+            (alias, val, raw)
+            for (alias, _, raw), val in zip(items, vals)]
+    if caching:
+        secret_cache().save()
+    if keys is not None:
+        return [_project(val, keys) for alias, val, raw in items]
+    return [val for alias, val, raw in items]
+
+
 def fallthrough_pipeline(*pipeline_interfaces):
+    """Passes the result of the decorated data_store method through the
+    enabled plugins of each of the pipeline interfaces, in turn, using each
+    interface's PrefixDispatcher.
+
+    The decorated method's first argument after self is taken to be the
+    alias.  Values changed by a plugin that sets 'cache_ttl' are kept in the
+    secret cache, and served from there on later calls until they expire.
+
+    Callers can pass resolve_secrets=False to skip the pipeline entirely,
+    or resolve_secrets='lazy' to get a LazyEnvironment, and keys=[...] to
+    only get (and resolve) those variables.  The pipeline interfaces are
+    kept on the wrapper, so that environment_variables_many can resolve
+    many aliases together.
+    """
     def decorator(function):
         def wrapper(*args, **kwargs):
-            global registry
-            val = function(*args, **kwargs)
-            for interface_name in pipeline_interfaces:
-                for keyname in registry.keynames(interface_name):
-                    plugin = registry.plugin(interface_name, keyname)
-                    if plugin:
-                        val = plugin()(val)
-            return val
+            resolve_secrets = kwargs.pop('resolve_secrets', True)
+            keys = kwargs.pop('keys', None)
+            alias = args[1] if len(args) > 1 else kwargs.get('alias')
+            if not resolve_secrets:
+                val = function(*args, **kwargs)
+                return val if keys is None else _project(val, set(keys))
+            with instrument.timed('datastore.environment', alias=alias):
+                val = function(*args, **kwargs)
+            return resolve_environments(
+                pipeline_interfaces, [(alias, val)], keys=keys,
+                lazy=resolve_secrets == 'lazy')[0]
+        wrapper.pipeline_interfaces = pipeline_interfaces
         return wrapper
     return decorator
 
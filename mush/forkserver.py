@@ -0,0 +1,401 @@
+"""
+Runs Python client commands without starting a new interpreter, and
+importing the client's libraries again, for every alias.
+
+Commands are mapped to their entry points in the [forkserver] section of
+the config, the same 'module:function' a console script names, optionally
+followed by more modules to import up front:
+
+    [forkserver]
+    openstack=openstackclient.shell:main
+    nova=novaclient.shell:main novaclient.v2.client
+
+The first time mush runs one of them, it forks a server process that
+imports the entry point once.  For every alias the server forks a child,
+which applies the alias' environment and argv, calls the entry point and
+exits with its exit code, just as the console script would.
+
+Python 2 can't pass file descriptors between processes, so children that
+need their output piped back write it to named pipes mush creates, and
+their exit codes are reported over the socket mush talks to the server on.
+"""
+import atexit
+import errno
+import fcntl
+import importlib
+import json
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import traceback
+from subprocess import PIPE
+from mush import engine, instrument
+
+
+class ForkServerError(Exception):
+    pass
+
+
+def entry_points():
+    """Returns a dict of command to (module:function, [modules to import])"""
+    if not engine.config._config.has_section('forkserver'):
+        return dict()
+    points = dict()
+    for command, value in engine.config._config.items('forkserver'):
+        words = value.split()
+        if words:
+            points[command] = (words[0], words[1:])
+    return points
+
+
+def _load(entry_point, preload):
+    for module in preload:
+        importlib.import_module(module)
+    module, _, function = entry_point.partition(':')
+    target = importlib.import_module(module)
+    for name in function.split('.'):
+        target = getattr(target, name)
+    return target
+
+
+def _send(connection, message):
+    connection.sendall(json.dumps(message) + "\n")
+
+
+def _exit_code(code):
+    """Turns the argument of sys.exit into an exit status, as Python does"""
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code & 0xff
+    print >> sys.stderr, code
+    return 1
+
+
+def _open_output(path):
+    """Opens the file (or named pipe, which mush has already opened for
+    reading) a child writes to"""
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+    return fd
+
+
+def _run_child(function, request, outputs):
+    """Runs in the child forked for a request, and never returns"""
+    code = 1
+    try:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for target, fd in outputs:
+            os.dup2(fd, target)
+            os.close(fd)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.argv = [str(arg) for arg in request['argv']]
+        try:
+            code = _exit_code(function())
+        except SystemExit as exception:
+            code = _exit_code(exception.code)
+        except KeyboardInterrupt:
+            code = 128 + signal.SIGINT
+        except BaseException:
+            traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def _serve(connection, function):
+    """The server's loop: forks a child for every request, and reports
+    each child's exit code once it has exited"""
+    # Ctrl-C is for the clients, and the server goes when mush does
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    wakeup_read, wakeup_write = os.pipe()
+    fcntl.fcntl(wakeup_write, fcntl.F_SETFL, os.O_NONBLOCK)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    children = dict()
+    pending = ''
+    _send(connection, {'ready': True})
+    while True:
+        try:
+            ready = select.select([connection, wakeup_read], [], [])[0]
+        except select.error as exception:
+            if exception.args[0] == errno.EINTR:
+                continue
+            raise
+        if wakeup_read in ready:
+            os.read(wakeup_read, 512)
+        while children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if not pid:
+                break
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+            _send(connection, {
+                'id': children.pop(pid), 'returncode': returncode})
+        if connection not in ready:
+            continue
+        data = connection.recv(65536)
+        if not data:
+            return
+        pending += data
+        while "\n" in pending:
+            line, pending = pending.split("\n", 1)
+            request = json.loads(line)
+            outputs = []
+            try:
+                for target, name in ((1, 'stdout'), (2, 'stderr')):
+                    if request.get(name):
+                        outputs.append((target, _open_output(request[name])))
+            except OSError as exception:
+                for target, fd in outputs:
+                    os.close(fd)
+                _send(connection, {
+                    'id': request['id'], 'error': str(exception)})
+                continue
+            pid = os.fork()
+            if not pid:
+                signal.set_wakeup_fd(-1)
+                connection.close()
+                os.close(wakeup_read)
+                os.close(wakeup_write)
+                _run_child(function, request, outputs)
+            for target, fd in outputs:
+                os.close(fd)
+            children[pid] = request['id']
+            _send(connection, {'id': request['id'], 'pid': pid})
+
+
+class ForkedProcess(object):
+    """A client run by a ForkServer, with the parts of the Popen interface
+    mush's runner uses"""
+
+    def __init__(self, server, number, pid, stdout, stderr):
+        self.server = server
+        self.number = number
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode = self.server._returncode(self.number, False)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = self.server._returncode(self.number, True)
+        return self.returncode
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def communicate(self):
+        """Reads stdout and stderr to the end, and waits for the client to
+        exit.  Returns (stdout, stderr), like Popen.communicate."""
+        output = dict()
+
+        def read(name, pipe):
+            output[name] = pipe.read()
+            pipe.close()
+
+        pipes = (('stdout', self.stdout), ('stderr', self.stderr))
+        readers = [
+            threading.Thread(target=read, args=(name, pipe))
+            for name, pipe in pipes if pipe]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        self.wait()
+        return output.get('stdout'), output.get('stderr')
+
+
+class ForkServer(object):
+    """Talks to the server process that runs command's entry point"""
+
+    def __init__(self, command, entry_point, preload=()):
+        self.command = command
+        self.entry_point = entry_point
+        self.preload = list(preload)
+        self.pid = None
+        self._connection = None
+        self._lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._replies = dict()
+        self._next = 0
+        self._alive = False
+        self._fifos = None
+
+    def start(self):
+        """Forks the server, and waits until it has imported the entry
+        point.  Must be called before mush starts any threads."""
+        ours, theirs = socket.socketpair()
+        # Anything buffered would otherwise be written again by children
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with instrument.timed('forkserver.start', command=self.command):
+            pid = os.fork()
+            if not pid:
+                ours.close()
+                try:
+                    try:
+                        function = _load(self.entry_point, self.preload)
+                    except Exception as exception:
+                        _send(theirs, {'error': "{0}: {1}".format(
+                            type(exception).__name__, exception)})
+                    else:
+                        _serve(theirs, function)
+                finally:
+                    os._exit(0)
+            theirs.close()
+            self.pid = pid
+            self._connection = ours
+            reader = ours.makefile('rb')
+            line = reader.readline()
+        hello = json.loads(line) if line else {'error': 'exited'}
+        if not hello.get('ready'):
+            os.waitpid(pid, 0)
+            raise ForkServerError("Unable to load {0}: {1}".format(
+                self.entry_point, hello.get('error')))
+        self._alive = True
+        self._fifos = tempfile.mkdtemp(prefix='mush-forkserver-')
+        thread = threading.Thread(target=self._read_replies, args=(reader,))
+        thread.daemon = True
+        thread.start()
+
+    def _read_replies(self, reader):
+        for line in iter(reader.readline, ''):
+            reply = json.loads(line)
+            with self._condition:
+                self._replies.setdefault(reply['id'], dict()).update(reply)
+                self._condition.notify_all()
+        with self._condition:
+            self._alive = False
+            self._condition.notify_all()
+
+    def _reply(self, number, key, block=True):
+        with self._condition:
+            while True:
+                reply = self._replies.get(number, dict())
+                if key in reply or 'error' in reply:
+                    return reply
+                if not block or not self._alive:
+                    return None
+                self._condition.wait()
+
+    def _returncode(self, number, block):
+        reply = self._reply(number, 'returncode', block)
+        if reply is None:
+            # The server went away without saying how the client exited
+            return -1 if block or not self._alive else None
+        with self._condition:
+            self._replies.pop(number, None)
+        return reply.get('returncode', -1)
+
+    def _output(self, number, name, target):
+        """Returns (path for the child to write to, file for mush to read
+        from) for a Popen style stdout or stderr argument"""
+        if target == PIPE:
+            path = os.path.join(
+                self._fifos, "{0}.{1}".format(number, name))
+            os.mkfifo(path, 0o600)
+            # Opened before the child, so its end doesn't block
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+            return path, os.fdopen(fd, 'rb')
+        name = getattr(target, 'name', None)
+        if isinstance(name, basestring) and os.path.isabs(name):
+            return name, None
+        # Anything else is inherited from mush
+        return None, None
+
+    def popen(self, argv, stdout=None, stderr=None, env=None, shell=False,
+              preexec_fn=None):
+        """Starts argv, like Popen(argv, ...) would.  stdout and stderr may
+        be None (inherit mush's), PIPE or a file opened by name."""
+        if shell:
+            raise ForkServerError("Fork servers can't run shell commands")
+        with self._lock:
+            number = self._next
+            self._next += 1
+        out_path, out_file = self._output(number, 'stdout', stdout)
+        err_path, err_file = self._output(number, 'stderr', stderr)
+        try:
+            with self._lock:
+                _send(self._connection, {
+                    'id': number, 'argv': list(argv),
+                    'env': dict(env if env is not None else os.environ),
+                    'stdout': out_path, 'stderr': err_path})
+            reply = self._reply(number, 'pid')
+        finally:
+            for path in (out_path, err_path):
+                if path and path.startswith(self._fifos):
+                    os.remove(path)
+        if reply is None or 'error' in reply:
+            for pipe in (out_file, err_file):
+                if pipe:
+                    pipe.close()
+            raise ForkServerError("Unable to run {0}: {1}".format(
+                self.command, (reply or dict()).get('error', 'exited')))
+        return ForkedProcess(self, number, reply['pid'], out_file, err_file)
+
+    def stop(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+        if self._fifos:
+            shutil.rmtree(self._fifos, ignore_errors=True)
+            self._fifos = None
+
+
+_servers = dict()
+
+
+def server(command):
+    """Returns the started ForkServer for command, or None if command isn't
+    configured to use one or its server can't be started"""
+    if command in _servers:
+        return _servers[command]
+    points = entry_points()
+    name = os.path.basename(command)
+    _servers[command] = None
+    if name in points:
+        entry_point, preload = points[name]
+        forkserver = ForkServer(name, entry_point, preload)
+        try:
+            forkserver.start()
+        except (ForkServerError, OSError) as exception:
+            print >> sys.stderr, "{0}, running it normally".format(exception)
+        else:
+            if not any(_servers.values()):
+                atexit.register(stop)
+            _servers[command] = forkserver
+    return _servers[command]
+
+
+def stop():
+    for forkserver in _servers.values():
+        if forkserver:
+            forkserver.stop()
+    _servers.clear()
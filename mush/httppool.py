@@ -0,0 +1,61 @@
+"""
+Keep-alive HTTP(S) connections for plugins that talk to web services.
+"""
+import httplib
+import socket
+import threading
+import urlparse
+
+
+class ConnectionPool(object):
+    """Keeps idle keep-alive connections to each (scheme, host, port), so
+    that requests made one after the other, or from several threads, don't
+    each pay for a new connection"""
+
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self._idle = dict()
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, host, port, timeout):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=timeout)
+        return httplib.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, url, headers, timeout, body=None):
+        """Makes a request, returning (status, response headers, body)"""
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = urlparse.urlunsplit(
+            ('', '', parts.path or '/', parts.query, ''))
+        with self._lock:
+            idle = self._idle.setdefault(key, list())
+            connection = idle.pop() if idle else None
+        # A reused connection may have been closed by the server since it
+        # was last used, in which case the request is retried on a new one
+        for attempt in ([connection, None] if connection else [None]):
+            connection = attempt or self._connect(
+                parts.scheme, parts.hostname, parts.port, timeout)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if attempt is None:
+                    raise
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                idle = self._idle.setdefault(key, list())
+                if len(idle) < self.max_idle:
+                    idle.append(connection)
+                else:
+                    connection.close()
+        return response.status, dict(response.getheaders()), content
+
+
+# Shared by every plugin in the process
+pool = ConnectionPool()
@@ -0,0 +1,147 @@
+"""
+Timing instrumentation for a single mush invocation.
+
+Phases of a run are wrapped in timed(phase, **tags).  Spans are recorded
+from the moment mush is imported, so that config loading and plugin imports
+are covered, until the CLI has parsed its flags and either enables
+reporting (--profile, or the MUSH_PROFILE environment variable) or disables
+recording altogether.
+
+MUSH_PROFILE may be set to 'table', 'json' or 'chrome' (a Chrome trace
+that can be loaded in chrome://tracing or Perfetto); any other non-empty
+value means 'table'.  Reports go to stderr, or to the file named by
+MUSH_PROFILE_OUTPUT.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+FORMATS = ('table', 'json', 'chrome')
+
+_origin = time.time()
+_spans = []
+_recording = True
+_format = None
+_output = os.environ.get('MUSH_PROFILE_OUTPUT')
+
+
+class Span(object):
+    __slots__ = ('phase', 'start', 'duration', 'tags', 'thread')
+
+    def __init__(self, phase, start, duration, tags, thread):
+        self.phase = phase
+        self.start = start
+        self.duration = duration
+        self.tags = tags
+        self.thread = thread
+
+
+@contextmanager
+def timed(phase, **tags):
+    """Records how long the body of the with statement takes"""
+    if not _recording:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        _spans.append(Span(
+            phase, start, time.time() - start, tags,
+            threading.current_thread().ident))
+
+
+def enable(report_format=None, output=None):
+    """Turns on reporting, in report_format"""
+    global _format, _output
+    _format = report_format if report_format in FORMATS else 'table'
+    _output = output or _output
+
+
+def disable():
+    """Stops recording spans and discards the ones already recorded"""
+    global _recording, _format
+    _recording = False
+    _format = None
+    del _spans[:]
+
+
+def enabled():
+    return _format is not None
+
+
+def _tag_string(tags):
+    return ", ".join(
+        "{0}={1}".format(k, v) for k, v in sorted(tags.items()))
+
+
+def _table():
+    import prettytable
+    # Aggregate by phase and tags, in the order each was first seen
+    rows = dict()
+    order = []
+    for span in sorted(_spans, key=lambda s: s.start):
+        key = (span.phase, _tag_string(span.tags))
+        if key not in rows:
+            rows[key] = [0, 0.0, 0.0]
+            order.append(key)
+        row = rows[key]
+        row[0] += 1
+        row[1] += span.duration
+        row[2] = max(row[2], span.duration)
+    p = prettytable.PrettyTable(
+        field_names=["Phase", "Detail", "Calls", "Total (ms)", "Max (ms)"])
+    p.align["Phase"] = "l"
+    p.align["Detail"] = "l"
+    for key in order:
+        calls, total, longest = rows[key]
+        p.add_row((
+            key[0], key[1], calls, "{0:.2f}".format(total * 1000),
+            "{0:.2f}".format(longest * 1000)))
+    return "{0}\nTotal: {1:.2f} ms\n".format(
+        p, (time.time() - _origin) * 1000)
+
+
+def _json():
+    return json.dumps({
+        'total': time.time() - _origin,
+        'spans': [{
+            'phase': span.phase,
+            'start': span.start - _origin,
+            'duration': span.duration,
+            'tags': span.tags,
+            'thread': span.thread} for span in _spans]}, indent=2) + "\n"
+
+
+def _chrome():
+    pid = os.getpid()
+    return json.dumps({'traceEvents': [{
+        'name': span.phase,
+        'cat': 'mush',
+        'ph': 'X',
+        'ts': int((span.start - _origin) * 1000000),
+        'dur': int(span.duration * 1000000),
+        'pid': pid,
+        'tid': span.thread,
+        'args': span.tags} for span in _spans]}) + "\n"
+
+
+def report():
+    """Writes the report, if reporting is enabled, and stops recording"""
+    if not enabled():
+        return
+    text = {'table': _table, 'json': _json, 'chrome': _chrome}[_format]()
+    disable()
+    if _output:
+        with open(_output, 'w') as output_file:
+            output_file.write(text)
+    else:
+        sys.stderr.write(text)
+        sys.stderr.flush()
+
+
+if os.environ.get('MUSH_PROFILE'):
+    enable(os.environ.get('MUSH_PROFILE'))
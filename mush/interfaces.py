@@ -1,4 +1,13 @@
-from mush import engine
+from collections import OrderedDict
+from mush import cache, engine, runner
+
+# How many aliases environment_variables_many resolves together
+RESOLVE_BATCH = 64
+
+
+def _workers(plugin):
+    return int(plugin.cfg('max_workers') or engine.config.get_option(
+        'mush', 'resolve_workers', '8'))
 
 
 class persist_shell(engine.AutoRegisteringPlugin):
@@ -12,22 +21,128 @@ class persist_shell(engine.AutoRegisteringPlugin):
 class access_secret(engine.AutoRegisteringPlugin):
     __interface__ = 'access_secret'
     __api_visible__ = False
+    # Set by plugins whose __call__ may run in several threads at once,
+    # e.g. ones waiting on a service rather than prompting the user
+    __concurrent__ = False
+
+    def __call__(self, environment_variables):
+        """Returns environment_variables with its secrets resolved.
 
-    def __call__(self, value):
+        Plugins with a 'magic_prefix' option are only passed the variables
+        whose values start with that prefix.  Instances are reused for
+        every alias."""
         raise NotImplementedError
 
+    def call_many(self, environments):
+        """Returns a list of __call__(environment_variables) for every dict
+        in environments, the variables of several aliases.
+
+        Concurrent plugins are called for up to 'max_workers' ([mush]
+        resolve_workers by default) of them at a time.  Plugins that can do
+        better with all of them at once should override this."""
+        if self.__concurrent__ and len(environments) > 1:
+            return list(runner.imap(self, environments, _workers(self)))
+        return [self(env) for env in environments]
+
+    @classmethod
+    def reset(cls):
+        """Forget anything remembered from earlier calls.  Long running
+        processes call this before resolving secrets again."""
+        pass
+
 
 class data_store(engine.AutoRegisteringPlugin):
     __interface__ = 'data_store'
     __config_defaults__ = {'location': None}
+    # Set by datastores whose environment_variables may run in several
+    # threads at once, so environment_variables_many loads aliases
+    # concurrently
+    __concurrent__ = False
 
     def __init__(self, data_file=None):
         raise NotImplementedError
 
     def environment_variables(self, alias):
-        """Must accept a single string. Returns an OrderedDict"""
+        """Must accept a single string. Returns an ordered mapping of
+        variable name to value, such as an OrderedDict or a
+        store.EnvironmentView, which callers may modify.
+
+        Implementations should be decorated with
+        engine.fallthrough_pipeline('access_secret'), which also lets
+        callers pass resolve_secrets=False to get the values exactly as
+        stored, resolve_secrets='lazy' to only resolve secrets as they are
+        read, and keys=[...] to only get those variables."""
         raise NotImplementedError
 
     def available_aliases(self):
         """Returns a List"""
         raise NotImplementedError
+
+    def source_files(self):
+        """Returns a List of the paths of the files the datastore was loaded
+        from, so callers can tell when it needs reloading"""
+        return []
+
+    def version(self):
+        """Returns something JSON serializable that changes whenever the
+        datastore's contents do, or None if that can't be told.  Used to
+        invalidate anything derived from the datastore and cached."""
+        return cache.file_signature(*self.source_files()) or None
+
+    def groups(self):
+        """Returns a dict of group name to the list of aliases in it, for
+        datastores that group their aliases.  Groups are selected on the
+        command line like tags, as @group."""
+        return dict()
+
+    def variable_values(self, variable):
+        """Returns a dict of alias to the stored (unresolved) value of
+        variable, for every alias that has it"""
+        return dict(
+            (alias, env[variable]) for alias, env in
+            self.environment_variables_many(
+                self.available_aliases(), resolve_secrets=False,
+                keys=[variable])
+            if env.get(variable))
+
+    def environment_variables_many(self, aliases, resolve_secrets=True,
+                                   keys=None):
+        """Yields (alias, environment_variables(alias)) for every alias,
+        taking the same resolve_secrets and keys as environment_variables.
+
+        Aliases are loaded RESOLVE_BATCH at a time, and each batch is passed
+        through the access_secret pipeline together, so plugins can resolve
+        the secrets of several aliases at once.  Datastores that can load
+        several aliases more cheaply together than one at a time should
+        override this, and call it once they have."""
+        pipeline = getattr(
+            type(self).environment_variables, 'pipeline_interfaces', None)
+        if keys is not None:
+            keys = frozenset(keys)
+
+        def load(alias):
+            if pipeline is None:
+                env = self.environment_variables(alias)
+                if keys is None:
+                    return env
+                return OrderedDict((k, env[k]) for k in env if k in keys)
+            # The pipeline picks the keys out itself, since plugins may need
+            # the others to resolve them
+            return self.environment_variables(
+                alias, resolve_secrets=False,
+                keys=None if resolve_secrets else keys)
+
+        aliases = list(aliases)
+        for i in range(0, len(aliases), RESOLVE_BATCH):
+            batch = aliases[i:i + RESOLVE_BATCH]
+            if self.__concurrent__ and len(batch) > 1:
+                environments = list(runner.imap(
+                    load, batch, _workers(self)))
+            else:
+                environments = [load(alias) for alias in batch]
+            if pipeline is not None and resolve_secrets:
+                environments = engine.resolve_environments(
+                    pipeline, zip(batch, environments), keys=keys,
+                    lazy=resolve_secrets == 'lazy')
+            for alias, env in zip(batch, environments):
+                yield alias, env
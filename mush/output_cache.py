@@ -0,0 +1,126 @@
+"""
+Keeps the output of client commands, so that running the same read-only
+command against the same alias again within a TTL prints the stored output
+instead of calling out to the cloud again.
+
+Only commands allowed in the [output_cache] section of the config are
+cached:
+
+    [output_cache]
+    commands=nova list, glance image-list
+    max_size=64
+    cache_failures=false
+
+Entries are keyed by the alias, a hash of its resolved environment and the
+client command's argv, so any change to the environment (a rotated
+password, a different region) misses the cache.  Each entry is a file only
+the user can read, and the least recently used entries are removed once
+they take up more than 'max_size' megabytes.
+"""
+import hashlib
+import marshal
+import os
+import shlex
+import time
+from mush import cache, engine, runner
+
+# Bump whenever the layout of an entry changes
+ENTRY_VERSION = 1
+
+
+def allowlist():
+    """Returns the allowed commands, each as a list of words"""
+    commands = engine.config.get_option('output_cache', 'commands', '')
+    return [shlex.split(c) for c in commands.split(',') if c.strip()]
+
+
+def cache_failures():
+    return engine.config.get_option(
+        'output_cache', 'cache_failures', 'false').lower() == 'true'
+
+
+def allowed(argv):
+    """Returns True if argv starts with the words of an allowed command.
+    Commands are run through the shell, so any shell syntax (e.g. '&&' or
+    '$(...)') could run something else, and is never allowed."""
+    if runner.shell_syntax(argv):
+        return False
+    return any(
+        words and argv[:len(words)] == words for words in allowlist())
+
+
+class OutputCache(object):
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(alias, environment_variables, argv):
+        environment = hashlib.sha256("\0".join(
+            "{0}={1}".format(k, v)
+            for k, v in sorted(environment_variables.items()))).hexdigest()
+        return hashlib.sha256("\0".join(
+            [alias, environment] + list(argv))).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Returns (stdout, returncode) for an unexpired entry, or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as entry_file:
+                version, expires, returncode, stdout = \
+                    marshal.load(entry_file)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if version != ENTRY_VERSION or expires <= time.time():
+            return None
+        try:
+            # Mark the entry as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return stdout, returncode
+
+    def put(self, key, stdout, returncode, ttl):
+        try:
+            cache.atomic_write(self._path(key), marshal.dumps((
+                ENTRY_VERSION, time.time() + float(ttl), returncode,
+                stdout)))
+            self.evict()
+        except (IOError, OSError):
+            # The cache is only an optimization, carry on without it
+            pass
+
+    def evict(self):
+        """Removes the least recently used entries until the rest fit in
+        max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(self._path(name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+            total -= size
+
+
+def from_config():
+    directory = engine.config.get_option(
+        'output_cache', 'directory', engine.config.cache_path('output'))
+    max_size = float(engine.config.get_option('output_cache', 'max_size', 64))
+    return OutputCache(
+        os.path.abspath(os.path.expanduser(directory)),
+        int(max_size * 1024 * 1024))
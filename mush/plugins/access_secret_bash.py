@@ -1,21 +1,89 @@
+"""
+Resolves values by running them as shell commands.  Every distinct command
+is run once, concurrently with the others, and the first line of its output
+is used for every variable that referenced it.
+"""
+import os
+import sys
+import threading
 from subprocess import Popen, PIPE
-from mush import interfaces
+from mush import instrument, interfaces, runner
 
 
 class access_secret(interfaces.access_secret):
     __keyname__ = "exec_bash"
-    __config_defaults__ = {'magic_prefix': 'EXEC_BASH:'}
+    __config_defaults__ = {
+        'magic_prefix': 'EXEC_BASH:', 'cache_ttl': '0', 'max_workers': '8',
+        'timeout': '0'}
+
+    # Output of every command that has succeeded in this process, so that
+    # aliases sharing a command during a multi-alias run only run it once.
+    _results = dict()
+    _results_lock = threading.Lock()
 
     def __call__(self, environment_variables):
-        prefix = self.cfg("magic_prefix")
-        for k, v in environment_variables.iteritems():
-            if v.startswith(prefix):
-                cmd = v.replace(prefix, '')
-                p = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-                std_out, std_err = p.communicate()
-                if std_err and p.returncode:
-                    print "exec_bash exited with a non-zero return code"
-                    print std_err
-                    return environment_variables
-                environment_variables[k] = str(std_out).splitlines()[0]
-        return environment_variables
+        return self.resolve([environment_variables])[0]
+
+    def call_many(self, environments):
+        return self.resolve(environments)
+
+    @classmethod
+    def reset(cls):
+        with cls._results_lock:
+            cls._results.clear()
+
+    @classmethod
+    def resolve(cls, environments):
+        """Resolves the prefixed values in every dict in environments,
+        running each distinct command only once. Variables whose command
+        fails keep their unresolved value."""
+        prefix = cls.cfg("magic_prefix")
+        references = dict()
+        for env in environments:
+            for k, v in env.iteritems():
+                if v and v.startswith(prefix):
+                    cmd = v[len(prefix):]
+                    references.setdefault(cmd, []).append((env, k))
+
+        with cls._results_lock:
+            pending = [c for c in references if c not in cls._results]
+        if pending:
+            outcomes = runner.imap(
+                lambda cmd: cls._run(cmd, [k for env, k in references[cmd]]),
+                pending, int(cls.cfg("max_workers")))
+            for cmd, (output, error) in zip(pending, outcomes):
+                if error:
+                    for env, k in references.pop(cmd):
+                        print >> sys.stderr, (
+                            "exec_bash could not resolve {0}: {1}".format(
+                                k, error))
+                    continue
+                with cls._results_lock:
+                    cls._results[cmd] = output
+
+        for cmd, referrers in references.items():
+            for env, k in referrers:
+                env[k] = cls._results[cmd]
+        return environments
+
+    @classmethod
+    def _run(cls, cmd, variables):
+        """Returns (first line of output, None) or (None, error message)"""
+        timeout = float(cls.cfg("timeout") or 0)
+        with instrument.timed(
+                'exec_bash.command', variables=",".join(sorted(variables))):
+            # A session of its own lets a timeout kill everything the
+            # command started, but keeps the terminal's Ctrl-C from it
+            p = Popen(
+                cmd, stdout=PIPE, stderr=PIPE, shell=True,
+                preexec_fn=os.setsid if timeout else None)
+            std_out, std_err, timed_out = runner.communicate(p, timeout)
+        if timed_out:
+            return None, "timed out after {0} seconds".format(timeout)
+        if p.returncode:
+            return None, "exited with return code {0}{1}".format(
+                p.returncode, "\n" + std_err if std_err else "")
+        lines = str(std_out).splitlines()
+        if not lines:
+            return None, "produced no output"
+        return lines[0], None
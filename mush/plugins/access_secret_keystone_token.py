@@ -0,0 +1,194 @@
+"""
+Authenticates against Keystone once, and hands clients the token instead of
+making each of them authenticate again.
+
+Runs after the prefixed access_secret plugins (it has no magic_prefix), so
+it sees resolved passwords.  For environments with OS_AUTH_URL, OS_USERNAME
+and OS_PASSWORD it adds the token (as OS_TOKEN) and the endpoint of the
+configured service from the catalog (as OS_URL).  Tokens are kept in a file
+in the mush cache directory that only the user can read, keyed by the
+credentials they were issued for, and replaced with a new token once they
+are within 'refresh_before' seconds of expiring.  Aliases with different
+credentials are authenticated concurrently.
+"""
+import calendar
+import hashlib
+import httplib
+import json
+import socket
+import sys
+import threading
+import time
+from mush import cache, engine, httppool, instrument, interfaces
+
+
+class KeystoneError(Exception):
+    pass
+
+
+def _expires(timestamp):
+    """Converts a Keystone ISO 8601 UTC timestamp to seconds since the
+    epoch"""
+    return calendar.timegm(
+        time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+class access_secret(interfaces.access_secret):
+    __keyname__ = "keystone_token"
+    __concurrent__ = True
+    __config_defaults__ = {
+        'service_type': 'compute',
+        'endpoint_interface': 'public',
+        'refresh_before': '300',
+        'timeout': '10',
+        'token_variable': 'OS_TOKEN',
+        'url_variable': 'OS_URL'}
+
+    def __init__(self):
+        self._tokens = cache.TTLCache(
+            engine.config.cache_path('keystone_tokens.json'))
+        self._lock = threading.Lock()
+        # One lock per set of credentials, so aliases sharing them wait for
+        # one token rather than each authenticating
+        self._credential_locks = dict()
+
+    def __call__(self, environment_variables):
+        credentials = self._credentials(environment_variables)
+        if credentials is None:
+            return environment_variables
+        key = hashlib.sha256(json.dumps(credentials, sort_keys=True))
+        key = key.hexdigest()
+        with self._lock:
+            credential_lock = self._credential_locks.setdefault(
+                key, threading.Lock())
+        with credential_lock:
+            token = self._token(key, credentials)
+        if token is None:
+            return environment_variables
+        environment_variables[self.cfg("token_variable")] = \
+            str(token['token'])
+        if token['endpoint']:
+            environment_variables[self.cfg("url_variable")] = \
+                str(token['endpoint'])
+        return environment_variables
+
+    def _token(self, key, credentials):
+        """Returns the cached token for credentials, authenticating if there
+        isn't one, or None if that fails"""
+        with self._lock:
+            token = self._tokens.get(key)
+        if token is None:
+            try:
+                token, endpoint, expires = self._authenticate(credentials)
+            except (KeystoneError, httplib.HTTPException, socket.error,
+                    ValueError, KeyError, TypeError) as exception:
+                # One write, so messages from several threads don't mix
+                sys.stderr.write(
+                    "keystone_token could not authenticate {0}: {1}\n".format(
+                        credentials['username'], exception))
+                return None
+            ttl = expires - time.time() - float(self.cfg("refresh_before"))
+            token = {'token': token, 'endpoint': endpoint}
+            if ttl > 0:
+                with self._lock:
+                    self._tokens.set(key, token, ttl)
+                    try:
+                        self._tokens.save()
+                    except (IOError, OSError):
+                        pass
+        return token
+
+    def _credentials(self, env):
+        """Returns what is needed to authenticate, or None if env doesn't
+        have it"""
+        if not (env.get('OS_AUTH_URL') and env.get('OS_USERNAME') and
+                env.get('OS_PASSWORD')):
+            return None
+        return {
+            'auth_url': env['OS_AUTH_URL'].rstrip('/'),
+            'username': env['OS_USERNAME'],
+            'password': env['OS_PASSWORD'],
+            'project_name': env.get('OS_PROJECT_NAME') or env.get(
+                'OS_TENANT_NAME'),
+            'project_id': env.get('OS_PROJECT_ID') or env.get(
+                'OS_TENANT_ID'),
+            'user_domain': env.get('OS_USER_DOMAIN_NAME') or 'Default',
+            'project_domain': env.get('OS_PROJECT_DOMAIN_NAME') or 'Default',
+            'region': env.get('OS_REGION_NAME'),
+            'service_type': self.cfg("service_type"),
+            'interface': self.cfg("endpoint_interface")}
+
+    def _post(self, url, body):
+        with instrument.timed('keystone_token.authenticate', url=url):
+            status, headers, content = httppool.pool.request(
+                'POST', url, {
+                    'Content-Type': 'application/json',
+                    'Accept': 'application/json'},
+                float(self.cfg("timeout")), body=json.dumps(body))
+        if status not in (httplib.OK, httplib.CREATED):
+            raise KeystoneError("{0} returned HTTP {1}".format(url, status))
+        return headers, json.loads(content)
+
+    def _authenticate(self, credentials):
+        """Returns (token, endpoint, expiry time)"""
+        if credentials['auth_url'].endswith('/v2.0'):
+            return self._authenticate_v2(credentials)
+        return self._authenticate_v3(credentials)
+
+    def _authenticate_v2(self, c):
+        auth = {'passwordCredentials': {
+            'username': c['username'], 'password': c['password']}}
+        if c['project_id']:
+            auth['tenantId'] = c['project_id']
+        elif c['project_name']:
+            auth['tenantName'] = c['project_name']
+        headers, body = self._post(
+            c['auth_url'] + '/tokens', {'auth': auth})
+        access = body['access']
+        endpoint = None
+        for service in access.get('serviceCatalog', []):
+            if service.get('type') != c['service_type']:
+                continue
+            for candidate in service.get('endpoints', []):
+                if not c['region'] or candidate.get('region') == c['region']:
+                    endpoint = candidate.get(c['interface'] + 'URL')
+                    break
+            if endpoint:
+                break
+        return (
+            access['token']['id'], endpoint,
+            _expires(access['token']['expires']))
+
+    def _authenticate_v3(self, c):
+        auth_url = c['auth_url']
+        if not auth_url.endswith('/v3'):
+            auth_url += '/v3'
+        auth = {'identity': {'methods': ['password'], 'password': {'user': {
+            'name': c['username'], 'password': c['password'],
+            'domain': {'name': c['user_domain']}}}}}
+        if c['project_id']:
+            auth['scope'] = {'project': {'id': c['project_id']}}
+        elif c['project_name']:
+            auth['scope'] = {'project': {
+                'name': c['project_name'],
+                'domain': {'name': c['project_domain']}}}
+        headers, body = self._post(
+            auth_url + '/auth/tokens', {'auth': auth})
+        token = body['token']
+        endpoint = None
+        for service in token.get('catalog', []):
+            if service.get('type') != c['service_type']:
+                continue
+            for candidate in service.get('endpoints', []):
+                region = candidate.get('region_id') or candidate.get('region')
+                if candidate.get('interface') == c['interface'] and (
+                        not c['region'] or region == c['region']):
+                    endpoint = candidate.get('url')
+                    break
+            if endpoint:
+                break
+        if not headers.get('x-subject-token'):
+            raise KeystoneError("{0} returned no token".format(auth_url))
+        return (
+            headers['x-subject-token'], endpoint,
+            _expires(token['expires_at']))
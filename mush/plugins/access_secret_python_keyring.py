@@ -4,7 +4,8 @@ from mush import interfaces
 
 class access_secret(interfaces.access_secret):
     __keyname__ = "python_keyring"
-    __config_defaults__ = {'magic_prefix': 'KEYRING:', 'service': 'mush'}
+    __config_defaults__ = {
+        'magic_prefix': 'KEYRING:', 'service': 'mush', 'cache_ttl': '0'}
 
     def __call__(self, environment_variables):
         magic_prefix = self.cfg("magic_prefix")
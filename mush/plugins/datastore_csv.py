@@ -1,41 +1,224 @@
 # This contains the default implementations for all of mush's interfaces.
 import csv
+import hashlib
+import marshal
+import mmap
 import os
-from collections import OrderedDict
-from mush import interfaces, engine
+from array import array
+from mush import cache, interfaces, engine
+from mush.store import CompactStore, INDEX_TYPECODE
+
+# Bump whenever the layout of the compiled index changes
+INDEX_VERSION = 2
 
 
 class data_store(interfaces.data_store):
+    """Reads a csv file where the first row holds the aliases, the first
+    column holds the environment variable names, and each cell holds the
+    value of that variable for that alias.
+
+    Values are kept in a CompactStore.  The parsed file is compiled into an
+    index in the mush cache directory (the store's value table and each
+    alias' array of value indexes), which later runs load instead of
+    re-parsing the csv for as long as the file is unchanged.
+
+    With 'mode' set to 'streaming' nothing is loaded up front except the
+    header row.  The columns of the aliases actually asked for are then
+    extracted in a single pass over the file, so memory use depends on the
+    number of aliases used rather than the number in the file.
+    """
     __keyname__ = "csv"
     __config_defaults__ = {
-        'location': os.path.expanduser('~/.mush/datastore.csv')}
+        'location': os.path.expanduser('~/.mush/datastore.csv'),
+        'index_cache': 'true',
+        'index_validation': 'stat',
+        'mode': 'index',
+        'use_mmap': 'false'}
 
     def __init__(self):
-        self.data_file = self.cfg("location")
+        self.data_file = os.path.abspath(os.path.expanduser(
+            self.cfg("location")))
         self._column_headers = list()
-        self._row_data = OrderedDict()
-        self._parse_csv()
+        self._row_headers = list()
+        self._store = CompactStore()
+        self._alias_index = dict()
+        self._streaming = self.cfg('mode') == 'streaming'
+        self._load()
 
     @engine.fallthrough_pipeline('access_secret')
     def environment_variables(self, alias):
         # Extract the relevant environment variables for alias
-        env_vars = OrderedDict()
-        column_index = self._column_headers.index(alias)
-        for row_header, row in self._row_data.items():
-            env_vars[row_header] = row[column_index]
-        return env_vars
+        if self._streaming and alias not in self._store:
+            self._project([alias])
+        return self._store.environment(alias)
+
+    def environment_variables_many(self, aliases, **kwargs):
+        aliases = list(aliases)
+        if self._streaming:
+            self._project(a for a in aliases if a not in self._store)
+        return super(data_store, self).environment_variables_many(
+            aliases, **kwargs)
 
     def available_aliases(self):
         return self._column_headers
 
+    def source_files(self):
+        return [self.data_file]
+
+    def variable_values(self, variable):
+        # Read the variable's row alone, rather than every environment
+        if self._streaming:
+            row = self._read_row(variable)
+        elif variable in self._row_headers:
+            # The last row for a variable wins, as in environment_variables
+            position = len(self._row_headers) - 1 - \
+                self._row_headers[::-1].index(variable)
+            row = [
+                self._store.values[self._store.indexes(alias)[position]]
+                if alias in self._store else ''
+                for alias in self._column_headers]
+        else:
+            row = []
+        values = dict()
+        for i, (alias, value) in enumerate(zip(self._column_headers, row)):
+            # An alias named twice reads its first column, as in
+            # environment_variables
+            if value and self._alias_index[alias] == i:
+                values[alias] = value
+        return values
+
+    def _load(self):
+        if self._streaming:
+            self._read_header()
+        elif self.cfg('index_cache').lower() != 'true':
+            self._parse_csv()
+        else:
+            index_path = engine.config.cache_path(
+                'datastore_csv',
+                hashlib.sha1(self.data_file).hexdigest() + '.index')
+            signature = self._signature()
+            if not self._read_index(index_path, signature):
+                self._parse_csv()
+                self._write_index(index_path, signature)
+        self._alias_index = dict()
+        for i, alias in enumerate(self._column_headers):
+            self._alias_index.setdefault(alias, i)
+
+    def _lines(self, csv_file):
+        """Iterates over the lines of the open csv_file, reading through an
+        mmap of it if 'use_mmap' is set"""
+        if self.cfg('use_mmap').lower() == 'true' and \
+                os.fstat(csv_file.fileno()).st_size:
+            mapped = mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for line in iter(mapped.readline, ''):
+                    yield line
+            finally:
+                mapped.close()
+        else:
+            for line in csv_file:
+                yield line
+
+    def _read_header(self):
+        with open(self.data_file, 'rb') as csv_file:
+            csv_data = csv.reader(csv_file, delimiter=',', quotechar='"')
+            self._column_headers = csv_data.next()[1:]
+
+    def _read_row(self, variable):
+        """Returns the values of the last row for variable, without keeping
+        any other row in memory"""
+        values = []
+        with open(self.data_file, 'rb') as csv_file:
+            csv_data = csv.reader(
+                self._lines(csv_file), delimiter=',', quotechar='"')
+            csv_data.next()
+            for row in csv_data:
+                if row and row[0] == variable:
+                    values = row[1:]
+        return values
+
+    def _project(self, aliases):
+        """Extracts the columns for aliases in one pass over the file,
+        without keeping any other column in memory"""
+        indexes = [
+            (alias, self._alias_index[alias] + 1) for alias in set(aliases)]
+        if not indexes:
+            return
+        columns = dict((alias, list()) for alias, i in indexes)
+        row_headers = list()
+        with open(self.data_file, 'rb') as csv_file:
+            csv_data = csv.reader(
+                self._lines(csv_file), delimiter=',', quotechar='"')
+            csv_data.next()
+            for row in csv_data:
+                if not row:
+                    continue
+                row_headers.append(row[0])
+                for alias, i in indexes:
+                    columns[alias].append(row[i] if i < len(row) else '')
+        self._row_headers = row_headers
+        for alias, column in columns.items():
+            self._store.add(alias, row_headers, column)
+
+    def _signature(self):
+        """Identifies the current contents of the data file. By default
+        only its mtime and size are checked, set 'index_validation' to
+        'hash' to also compare a hash of its contents."""
+        signature = cache.file_signature(self.data_file)
+        if self.cfg('index_validation') == 'hash':
+            with open(self.data_file, 'rb') as csv_file:
+                signature.append(hashlib.sha1(csv_file.read()).hexdigest())
+        return signature
+
+    def _read_index(self, index_path, signature):
+        try:
+            with open(index_path, 'rb') as index_file:
+                version, index_signature = marshal.load(index_file)
+                if version != INDEX_VERSION or index_signature != signature:
+                    return False
+                aliases, rows, values, columns = marshal.load(index_file)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        self._column_headers = aliases
+        self._row_headers = rows
+        self._store = CompactStore(values)
+        for alias, indexes in zip(aliases, columns):
+            self._store.add_indexes(
+                alias, rows, array(INDEX_TYPECODE, indexes))
+        return True
+
+    def _write_index(self, index_path, signature):
+        try:
+            columns = [
+                self._store.indexes(alias).tostring()
+                for alias in self._column_headers if alias in self._store]
+            cache.atomic_write(index_path, marshal.dumps((
+                INDEX_VERSION, signature)) + marshal.dumps((
+                    self._column_headers, self._row_headers,
+                    self._store.values, columns)))
+        except (IOError, OSError):
+            # The index is only an optimization, carry on without it
+            pass
+
     def _parse_csv(self):
         csv_file = open(self.data_file, 'rb')
         csv_data = csv.reader(csv_file, delimiter=',', quotechar='"')
         self._column_headers = csv_data.next()[1:]
+        width = len(self._column_headers)
 
-        # Parse data
+        # Parse data, padding short rows so every alias has a value
+        rows = list()
         for row in csv_data:
-            # Extract the row data
-            row_header = row[0]
-            row_list = row[1:]
-            self._row_data[row_header] = row_list
+            if not row:
+                continue
+            self._row_headers.append(row[0])
+            row_list = row[1:width + 1]
+            row_list.extend([''] * (width - len(row_list)))
+            rows.append(row_list)
+        csv_file.close()
+
+        # Store the values column by column, one array per alias
+        columns = zip(*rows) or [() for alias in self._column_headers]
+        for alias, column in zip(self._column_headers, columns):
+            if alias not in self._store:
+                self._store.add(alias, self._row_headers, column)
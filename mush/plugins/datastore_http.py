@@ -0,0 +1,171 @@
+"""
+A datastore served over HTTP, e.g. by a central config service.
+
+The service must answer two GET requests, relative to 'location':
+
+    aliases                             A JSON list of alias names
+    environments?alias=a&alias=b...     A JSON object of alias to its
+                                        variables, either as an object or
+                                        as a list of [name, value] pairs
+
+Every response is kept in the mush cache directory, readable only by the
+user, along with its ETag and Last-Modified headers.  Later requests for the
+same thing are conditional, so an unchanged datastore costs a 304 rather
+than a download, and responses younger than 'revalidate_after' seconds are
+used without asking at all.  The environments of every alias a mush run
+uses are fetched with as few requests as possible (one per 'batch_size'
+aliases), over keep-alive connections that are reused for the whole run.
+"""
+import hashlib
+import httplib
+import json
+import os
+import socket
+import sys
+import time
+import urllib
+import urlparse
+from collections import OrderedDict
+from mush import cache, engine, httppool, instrument, interfaces
+from mush.store import CompactStore
+
+
+class HTTPDatastoreError(Exception):
+    pass
+
+
+class data_store(interfaces.data_store):
+    __keyname__ = "http"
+    __config_defaults__ = {
+        'location': None,
+        'auth_header': None,
+        'timeout': '10',
+        'revalidate_after': '0',
+        'batch_size': '200'}
+
+    def __init__(self):
+        self.url = self.cfg("location")
+        if not self.url:
+            print "Set 'location' in [data_store.http] to the datastore's URL"
+            sys.exit(1)
+        if not self.url.endswith('/'):
+            self.url += '/'
+        self.cache_dir = engine.config.cache_path(
+            'datastore_http', hashlib.sha1(self.url).hexdigest())
+        self._store = CompactStore()
+        # The last aliases response, and the aliases parsed from it
+        self._aliases = None
+
+    def _copy_path(self, url):
+        return os.path.join(
+            self.cache_dir, hashlib.sha1(url).hexdigest() + '.json')
+
+    def _read_copy(self, path):
+        try:
+            with open(path) as copy_file:
+                return json.load(copy_file)
+        except (IOError, ValueError):
+            return None
+
+    def _get(self, relative_url):
+        """Returns the body of the response to relative_url, revalidating
+        the on-disk copy of an earlier response if there is one"""
+        url = urlparse.urljoin(self.url, relative_url)
+        path = self._copy_path(url)
+        copy = self._read_copy(path)
+        if copy and time.time() - copy['fetched'] < float(
+                self.cfg("revalidate_after")):
+            return copy['body']
+
+        headers = {'Accept': 'application/json'}
+        if self.cfg("auth_header"):
+            name, _, value = self.cfg("auth_header").partition(':')
+            headers[name.strip()] = value.strip()
+        if copy and copy.get('etag'):
+            headers['If-None-Match'] = copy['etag']
+        if copy and copy.get('last_modified'):
+            headers['If-Modified-Since'] = copy['last_modified']
+        try:
+            with instrument.timed('datastore.http', url=url):
+                status, response_headers, body = httppool.pool.request(
+                    'GET', url, headers, float(self.cfg("timeout")))
+        except (httplib.HTTPException, socket.error) as exception:
+            if copy:
+                print >> sys.stderr, (
+                    "Unable to reach {0} ({1}), using the copy from "
+                    "{2}".format(url, exception, time.ctime(copy['fetched'])))
+                return copy['body']
+            raise HTTPDatastoreError(
+                "Unable to reach {0}: {1}".format(url, exception))
+
+        previous = copy or dict()
+        if status == httplib.NOT_MODIFIED and copy:
+            body = copy['body']
+        elif status != httplib.OK:
+            raise HTTPDatastoreError(
+                "{0} returned HTTP {1}".format(url, status))
+        else:
+            previous = dict()
+        # A 304 need not repeat the validators
+        copy = {
+            'fetched': time.time(),
+            'etag': response_headers.get('etag') or previous.get('etag'),
+            'last_modified': response_headers.get(
+                'last-modified') or previous.get('last_modified'),
+            'body': body}
+        try:
+            cache.atomic_write(path, json.dumps(copy))
+        except (IOError, OSError):
+            pass
+        return body
+
+    def _fetch(self, aliases):
+        """Fetches the environments of aliases into the store"""
+        aliases = sorted(set(aliases))
+        batch_size = int(self.cfg("batch_size"))
+        for i in range(0, len(aliases), batch_size):
+            batch = aliases[i:i + batch_size]
+            body = self._get('environments?' + urllib.urlencode(
+                [('alias', a) for a in batch]))
+            environments = json.loads(body, object_pairs_hook=OrderedDict)
+            for alias in batch:
+                variables = environments.get(alias)
+                if variables is None:
+                    raise HTTPDatastoreError(
+                        "{0} has no alias '{1}'".format(self.url, alias))
+                if isinstance(variables, dict):
+                    variables = variables.items()
+                self._store.add(
+                    alias, [_str(k) for k, v in variables],
+                    [_str(v) for k, v in variables])
+
+    @engine.fallthrough_pipeline('access_secret')
+    def environment_variables(self, alias):
+        # Extract the relevant environment variables for alias
+        if alias not in self._store:
+            self._fetch([alias])
+        return self._store.environment(alias)
+
+    def environment_variables_many(self, aliases, **kwargs):
+        # Fetch every alias in one batch, then pass each one through the
+        # pipeline as usual
+        aliases = list(aliases)
+        self._fetch(aliases)
+        return super(data_store, self).environment_variables_many(
+            aliases, **kwargs)
+
+    def available_aliases(self):
+        # Revalidated on every call (a long running agent keeps using the
+        # same data_store), which is cheap when nothing has changed
+        body = self._get('aliases')
+        if self._aliases is None or body != self._aliases[0]:
+            self._aliases = (body, [_str(a) for a in json.loads(body)])
+        return self._aliases[1]
+
+
+def _str(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
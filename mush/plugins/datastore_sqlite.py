@@ -0,0 +1,133 @@
+"""
+A datastore kept in a SQLite database, with one indexed row per alias and
+variable, so answering a lookup for one alias doesn't load any other.
+
+The database uses WAL journaling by default, so any number of mush
+processes can keep reading while it is being written to.  Fill it from an
+existing csv or supernova datastore with:
+
+    mush import-datastore --from=csv --to=sqlite
+"""
+import os
+import sqlite3
+from collections import OrderedDict
+from mush import engine, interfaces
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS aliases (
+    name TEXT PRIMARY KEY,
+    position INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS variables (
+    alias TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    variable TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (alias, position)) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS variables_by_name
+    ON variables (alias, variable);
+PRAGMA user_version = {version};
+""".format(version=SCHEMA_VERSION)
+
+# SQLite's default limit on the number of parameters in one statement
+MAX_PARAMETERS = 999
+
+
+class data_store(interfaces.data_store):
+    __keyname__ = "sqlite"
+    __config_defaults__ = {
+        'location': os.path.expanduser('~/.mush/datastore.sqlite'),
+        'journal_mode': 'wal',
+        'timeout': '5'}
+
+    def __init__(self):
+        self.data_file = os.path.abspath(os.path.expanduser(
+            self.cfg("location")))
+        # Callers that share a data_store between threads (like the agent)
+        # serialize their use of it
+        self.connection = sqlite3.connect(
+            self.data_file, timeout=float(self.cfg("timeout")),
+            check_same_thread=False)
+        self.connection.text_factory = str
+        version = self.connection.execute('PRAGMA user_version').fetchone()
+        if version[0] != SCHEMA_VERSION:
+            self.connection.executescript(SCHEMA)
+        self._prefetched = None
+        journal_mode = self.cfg("journal_mode")
+        if journal_mode:
+            self.connection.execute(
+                'PRAGMA journal_mode = {0}'.format(journal_mode))
+
+    @engine.fallthrough_pipeline('access_secret')
+    def environment_variables(self, alias):
+        # Extract the relevant environment variables for alias
+        if self._prefetched is not None and alias in self._prefetched:
+            return OrderedDict(self._prefetched[alias])
+        return OrderedDict(self.connection.execute(
+            'SELECT variable, value FROM variables WHERE alias = ? '
+            'ORDER BY position', (alias, )))
+
+    def environment_variables_many(self, aliases, **kwargs):
+        # Read every alias with one query per batch of aliases, then pass
+        # each one through the pipeline as usual
+        aliases = list(aliases)
+        rows = dict()
+        unique = list(set(aliases))
+        for i in range(0, len(unique), MAX_PARAMETERS):
+            batch = unique[i:i + MAX_PARAMETERS]
+            for alias, variable, value in self.connection.execute(
+                    'SELECT alias, variable, value FROM variables '
+                    'WHERE alias IN ({0}) ORDER BY alias, position'.format(
+                        ', '.join('?' * len(batch))), batch):
+                rows.setdefault(alias, list()).append((variable, value))
+        self._prefetched = rows
+        try:
+            for item in super(data_store, self).environment_variables_many(
+                    aliases, **kwargs):
+                yield item
+        finally:
+            self._prefetched = None
+
+    def available_aliases(self):
+        return [name for name, in self.connection.execute(
+            'SELECT name FROM aliases ORDER BY position')]
+
+    def variable_values(self, variable):
+        return dict(self.connection.execute(
+            'SELECT alias, value FROM variables '
+            'WHERE variable = ? AND value != \'\'', (variable, )))
+
+    def source_files(self):
+        return [self.data_file, self.data_file + '-wal']
+
+    def import_environments(self, environments, merge=False):
+        """Stores every (alias, [(variable, value), ...]) pair in
+        environments, in a single transaction.  Unless merge is set, any
+        aliases already stored are removed first.  Returns the number of
+        aliases imported."""
+        count = 0
+        with self.connection:
+            if not merge:
+                self.connection.execute('DELETE FROM variables')
+                self.connection.execute('DELETE FROM aliases')
+            position = self.connection.execute(
+                'SELECT COALESCE(MAX(position) + 1, 0) FROM aliases'
+            ).fetchone()[0]
+            for alias, items in environments:
+                self.connection.execute(
+                    'DELETE FROM variables WHERE alias = ?', (alias, ))
+                if not self.connection.execute(
+                        'SELECT 1 FROM aliases WHERE name = ?',
+                        (alias, )).fetchone():
+                    self.connection.execute(
+                        'INSERT INTO aliases (name, position) VALUES (?, ?)',
+                        (alias, position))
+                    position += 1
+                variables = OrderedDict(items)
+                self.connection.executemany(
+                    'INSERT INTO variables (alias, position, variable, value) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(alias, i, k, v if v is not None else '')
+                     for i, (k, v) in enumerate(variables.items())])
+                count += 1
+        return count
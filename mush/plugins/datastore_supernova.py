@@ -1,13 +1,32 @@
+"""
+Reads the environments in supernova's config files (~/.supernova, or
+'location', and ./.supernova), one alias per section.
+
+Sections are grouped the way supernova groups them, by their
+SUPERNOVA_GROUP variable (a comma or space separated list of groups), and
+each group can be selected like a tag, e.g. 'mush @prod nova list'.
+
+Every section is parsed once, and compiled with the groups into an index
+in the mush cache directory, which later runs load instead of parsing the
+files again for as long as none of them has changed.
+"""
+import hashlib
+import marshal
 import os
 import sys
-from collections import OrderedDict
+from array import array
 
 try:
     import ConfigParser
 except:
     import configparser as ConfigParser
 
-from mush import engine, interfaces
+from mush import alias_index, cache, engine, interfaces
+from mush.store import CompactStore, INDEX_TYPECODE
+
+# Bump whenever the layout of the compiled index changes
+INDEX_VERSION = 1
+GROUP_VARIABLE = 'SUPERNOVA_GROUP'
 
 
 class data_store(interfaces.data_store):
@@ -15,26 +34,117 @@ class data_store(interfaces.data_store):
     __config_defaults__ = {"location": os.path.expanduser("~/.supernova")}
 
     def __init__(self):
-        possible_configs = [self.cfg('location'), '.supernova']
-        self.supernova_config = ConfigParser.SafeConfigParser()
-        try:
-            self.supernova_config.read(possible_configs)
-        except:
-            msg = """
+        self._store = CompactStore()
+        self._sections = list()
+        self._groups = dict()
+        # Sections that couldn't be compiled, e.g. for a bad interpolation
+        self._unparsed = set()
+        self._parser = None
+        paths = self.source_files()
+        index_path = engine.config.cache_path(
+            'datastore_supernova',
+            hashlib.sha1("\0".join(paths)).hexdigest() + '.index')
+        signature = cache.file_signature(*paths)
+        if not self._read_index(index_path, signature):
+            self._compile()
+            self._write_index(index_path, signature)
+
+    def _config(self):
+        """Returns the files' parsed contents, only parsed when needed"""
+        if self._parser is None:
+            self._parser = ConfigParser.SafeConfigParser()
+            try:
+                self._parser.read(self.source_files())
+            except:
+                msg = """
 A valid supernova configuration file is required.
 Ensure that you have a properly configured supernova configuration file called
 '.supernova' in your home directory or in your current working directory.
 """
-            print(msg)
-            sys.exit(1)
+                print(msg)
+                sys.exit(1)
+        return self._parser
+
+    def _compile(self):
+        """Reads every section into the store, and groups them"""
+        config = self._config()
+        self._sections = config.sections()
+        for section in self._sections:
+            try:
+                items = config.items(section)
+            except ConfigParser.Error:
+                self._unparsed.add(section)
+                continue
+            names = [k.upper() for k, v in items]
+            self._store.add(section, names, [v for k, v in items])
+            for group in alias_index.TAG_SEPARATORS.split(
+                    dict(items).get(GROUP_VARIABLE.lower(), '')):
+                if group:
+                    self._groups.setdefault(group, list()).append(section)
+
+    def _read_index(self, index_path, signature):
+        try:
+            with open(index_path, 'rb') as index_file:
+                version, index_signature = marshal.load(index_file)
+                if version != INDEX_VERSION or index_signature != signature:
+                    return False
+                sections, unparsed, groups, values, entries = \
+                    marshal.load(index_file)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        self._sections = sections
+        self._unparsed = set(unparsed)
+        self._groups = groups
+        self._store = CompactStore(values)
+        for section, names, indexes in entries:
+            self._store.add_indexes(
+                section, names, array(INDEX_TYPECODE, indexes))
+        return True
+
+    def _write_index(self, index_path, signature):
+        try:
+            entries = [
+                (section, list(self._store.environment(section)),
+                 self._store.indexes(section).tostring())
+                for section in self._sections if section in self._store]
+            cache.atomic_write(index_path, marshal.dumps((
+                INDEX_VERSION, signature)) + marshal.dumps((
+                    self._sections, list(self._unparsed), self._groups,
+                    self._store.values, entries)))
+        except (IOError, OSError, ValueError):
+            # The index is only an optimization, carry on without it
+            pass
 
     @engine.fallthrough_pipeline('access_secret')
     def environment_variables(self, alias):
         # Extract the relevant environment variables for alias
-        env_vars = OrderedDict()
-        for k, v in self.supernova_config.items(alias):
-            env_vars[k.upper()] = v
-        return env_vars
+        if alias in self._unparsed:
+            # Raises whatever stopped the section from being compiled
+            self._config().items(alias)
+        return self._store.environment(alias)
 
     def available_aliases(self):
-        return self.supernova_config.sections()
+        return self._sections
+
+    def variable_values(self, variable):
+        # Read from the store, so sections that couldn't be compiled are
+        # skipped rather than stopping every alias' value from being read
+        values = dict()
+        for section in self._sections:
+            if section in self._store:
+                value = self._store.environment(section).get(variable)
+                if value:
+                    values[section] = value
+        return values
+
+    def groups(self):
+        if self._unparsed:
+            print >> sys.stderr, (
+                "supernova sections that couldn't be parsed are left out of "
+                "their groups: {0}".format(", ".join(sorted(self._unparsed))))
+        return self._groups
+
+    def source_files(self):
+        return [
+            os.path.abspath(os.path.expanduser(p))
+            for p in [self.cfg('location'), '.supernova']]
@@ -0,0 +1,385 @@
+"""
+Runs client commands in subprocesses, once per alias, with a bounded pool
+of workers so that calls against many aliases can overlap.
+"""
+import os
+import Queue
+import signal
+import sys
+import threading
+import time
+from subprocess import Popen, PIPE
+from mush import instrument
+
+# How long the main thread waits on workers at a time.  Python 2 only
+# delivers Ctrl-C to a thread waiting with a timeout.
+WAIT_INTERVAL = 0.1
+# How long workers get to finish once mush has been interrupted
+INTERRUPT_GRACE = 1
+
+# Processes being waited on by communicate(), so they can be killed when
+# mush is interrupted.  Those started in sessions of their own never see the
+# terminal's Ctrl-C.
+_running = set()
+_running_lock = threading.Lock()
+
+# Characters a shell gives a meaning of their own
+SHELL_CHARACTERS = frozenset(' \t\n|&;<>()$`\\"\'*?[]{}#~!')
+
+
+def shell_syntax(words):
+    """Returns True if a shell, given the words joined with spaces, might
+    run anything other than the words themselves as one argv"""
+    return any(not word or SHELL_CHARACTERS.intersection(word)
+               for word in words)
+
+
+class Result(object):
+    """Outcome of running a client command for a single alias"""
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.returncode = None
+        self.stdout = ''
+        self.stderr = ''
+        self.duration = None
+        # Set when the output came from the output cache
+        self.cached = False
+        self.attempts = 0
+        self.timed_out = False
+
+
+def imap(function, items, workers):
+    """Like itertools.imap, but calls function on up to 'workers' items at
+    a time, each in its own thread.  Results are yielded in the order of
+    items, each as soon as it and all the ones before it are ready."""
+    items = list(items)
+    pending = Queue.Queue()
+    finished = Queue.Queue()
+    for i, item in enumerate(items):
+        pending.put((i, item))
+
+    def work():
+        while True:
+            try:
+                i, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                finished.put((i, True, function(item)))
+            except Exception:
+                finished.put((i, False, sys.exc_info()))
+
+    threads = []
+    for n in range(max(1, min(workers, len(items)))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    ready = dict()
+    interrupted = False
+    try:
+        for i in range(len(items)):
+            while i not in ready:
+                try:
+                    j, ok, value = finished.get(timeout=WAIT_INTERVAL)
+                except Queue.Empty:
+                    continue
+                ready[j] = (ok, value)
+            ok, value = ready.pop(i)
+            if not ok:
+                raise value[0], value[1], value[2]
+            yield value
+    except KeyboardInterrupt:
+        interrupted = True
+        _drain(pending)
+        kill_running()
+        raise
+    finally:
+        # The workers must not outlive the interpreter, even when the
+        # caller stops early (zip() never asks for the item after the last).
+        # Once interrupted, they are only given a moment to finish.
+        _join(threads, INTERRUPT_GRACE if interrupted else None)
+
+
+def _join(threads, timeout=None):
+    """Waits for threads to finish, for at most timeout seconds in all"""
+    deadline = time.time() + timeout if timeout is not None else None
+    for thread in threads:
+        if deadline is None:
+            thread.join()
+        else:
+            thread.join(max(0, deadline - time.time()))
+
+
+def _drain(queue):
+    while True:
+        try:
+            queue.get_nowait()
+        except Queue.Empty:
+            return
+
+
+def _kill(process):
+    """Kills process, along with its process group if it leads one"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
+def kill_running():
+    """Kills every process communicate() is waiting on"""
+    with _running_lock:
+        processes = list(_running)
+    for process in processes:
+        _kill(process)
+
+
+def communicate(process, timeout=None):
+    """Like process.communicate(), but kills the process if it runs for
+    longer than timeout seconds.  Processes started with
+    preexec_fn=os.setsid are killed along with their whole process group, so
+    commands run through a shell don't leave children behind.
+
+    Returns (stdout, stderr, timed_out)
+    """
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        _kill(process)
+
+    timer = threading.Timer(float(timeout), kill) if timeout else None
+    if timer:
+        timer.start()
+    with _running_lock:
+        _running.add(process)
+    try:
+        stdout, stderr = process.communicate()
+    finally:
+        with _running_lock:
+            _running.discard(process)
+        if timer:
+            timer.cancel()
+    return stdout, stderr, bool(timed_out)
+
+
+def _relay(pipe, out, prefix, lock):
+    """Copies every line read from pipe to out, prefixed, one whole line at
+    a time so that output from concurrent aliases never interleaves
+    mid-line"""
+    for line in iter(pipe.readline, ''):
+        if not line.endswith('\n'):
+            line += '\n'
+        with lock:
+            out.write(prefix + line)
+            out.flush()
+    pipe.close()
+
+
+def run_captured(command, alias, env, popen=Popen):
+    """Runs command and buffers its stdout and stderr in the Result.
+    command is run through the shell if it is a string, or directly (by
+    popen, which may be a fork server's) if it is a list."""
+    result = Result(alias)
+    start = time.time()
+    with instrument.timed('client', alias=alias):
+        p = popen(
+            command, stdout=PIPE, stderr=PIPE,
+            shell=isinstance(command, basestring), env=env)
+        result.stdout, result.stderr = p.communicate()
+    result.returncode = p.returncode
+    result.duration = time.time() - start
+    return result
+
+
+def run_prefixed(command, alias, env, lock, stdout=None, stderr=None,
+                 popen=Popen):
+    """Runs command and streams each line it writes to stdout/stderr as soon
+    as it is available, prefixed with the alias.  If stderr is None the
+    command's stderr is discarded.  command is run like run_captured's."""
+    stdout = stdout or sys.stdout
+    result = Result(alias)
+    prefix = "[{0}] ".format(alias)
+    start = time.time()
+    devnull = None if stderr else open(os.devnull, 'w')
+    p = popen(
+        command, stdout=PIPE, stderr=PIPE if stderr else devnull,
+        shell=isinstance(command, basestring), env=env)
+    readers = [threading.Thread(
+        target=_relay, args=(p.stdout, stdout, prefix, lock))]
+    if stderr:
+        readers.append(threading.Thread(
+            target=_relay, args=(p.stderr, stderr, prefix, lock)))
+    with instrument.timed('client', alias=alias):
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        result.returncode = p.wait()
+    result.duration = time.time() - start
+    if devnull:
+        devnull.close()
+    return result
+
+
+def _replay_prefixed(result, lock, stdout=None):
+    """Writes a Result's buffered stdout the way run_prefixed would have"""
+    stdout = stdout or sys.stdout
+    prefix = "[{0}] ".format(result.alias)
+    with lock:
+        for line in result.stdout.splitlines(True):
+            if not line.endswith('\n'):
+                line += '\n'
+            stdout.write(prefix + line)
+        stdout.flush()
+
+
+def run_parallel(
+        command, jobs, workers, on_result=None, prefix_output=False,
+        stderr=None, cached=None, popen=Popen):
+    """Runs command once for every (alias, env) pair in jobs, with at most
+    'workers' commands running at the same time.  command and popen are
+    as for run_captured.
+
+    By default each command's output is buffered, and on_result is called
+    with each Result in the same order as jobs, as soon as it and every
+    job before it have finished.  With prefix_output, output is streamed
+    line by line (see run_prefixed) and on_result only sees the exit
+    status.
+
+    cached is a dict of alias to a Result to use for that alias instead of
+    running the command.
+
+    Returns the list of Results, in job order.
+    """
+    lock = threading.Lock()
+    cached = cached or dict()
+
+    def worker(job):
+        alias, env = job
+        if alias in cached:
+            if prefix_output:
+                _replay_prefixed(cached[alias], lock)
+            return cached[alias]
+        if prefix_output:
+            return run_prefixed(
+                command, alias, env, lock, stderr=stderr, popen=popen)
+        return run_captured(command, alias, env, popen=popen)
+
+    results = []
+    for result in imap(worker, jobs, workers):
+        results.append(result)
+        if on_result:
+            on_result(result)
+    return results
+
+
+class Job(object):
+    """A command to run for an alias, as part of run_jobs.  command is run
+    through the shell if it is a string, or directly if it is a list.  Its
+    output is written to the files at stdout_path and stderr_path."""
+
+    def __init__(self, number, alias, command, stdout_path, stderr_path,
+                 timeout=None, retries=0):
+        self.number = number
+        self.alias = alias
+        self.command = command
+        self.stdout_path = stdout_path
+        self.stderr_path = stderr_path
+        self.timeout = timeout
+        self.retries = retries
+
+
+def run_job(job, env):
+    """Runs job until it succeeds, or has been retried job.retries times"""
+    result = Result(job.alias)
+    start = time.time()
+    while True:
+        result.attempts += 1
+        with open(job.stdout_path, 'wb') as stdout, \
+                open(job.stderr_path, 'wb') as stderr:
+            with instrument.timed('client', alias=job.alias):
+                p = Popen(
+                    job.command, stdout=stdout, stderr=stderr,
+                    shell=isinstance(job.command, basestring), env=env,
+                    preexec_fn=os.setsid)
+                result.timed_out = communicate(p, job.timeout)[2]
+        result.returncode = p.returncode
+        if result.returncode == 0 or result.attempts > job.retries:
+            break
+    result.duration = time.time() - start
+    return result
+
+
+def run_jobs(jobs, environments, workers, per_alias=None, on_result=None):
+    """Runs every Job in jobs with at most 'workers' running at the same
+    time, and at most 'per_alias' of them for the same alias.  Each job is
+    run with environments[job.alias].
+
+    on_result is called with (job, Result) as each job finishes, in the
+    order they finish.  Returns the Results, in job order."""
+    jobs = list(jobs)
+    pending = list(jobs)
+    running = dict()
+    results = dict()
+    condition = threading.Condition()
+
+    def next_job():
+        """Takes the first pending job whose alias is below its cap"""
+        for i, job in enumerate(pending):
+            if not per_alias or running.get(job.alias, 0) < per_alias:
+                running[job.alias] = running.get(job.alias, 0) + 1
+                return pending.pop(i)
+
+    def work():
+        while True:
+            with condition:
+                job = next_job()
+                while job is None and pending:
+                    condition.wait()
+                    job = next_job()
+            if job is None:
+                return
+            try:
+                result = run_job(job, environments[job.alias])
+            except Exception as exception:
+                result = Result(job.alias)
+                result.returncode = -1
+                result.stderr = "Unable to run job {0}: {1}\n".format(
+                    job.number, exception)
+                try:
+                    with open(job.stderr_path, 'ab') as stderr:
+                        stderr.write(result.stderr)
+                except IOError:
+                    sys.stderr.write(result.stderr)
+            with condition:
+                running[job.alias] -= 1
+                results[job.number] = result
+                if on_result:
+                    on_result(job, result)
+                condition.notify_all()
+
+    threads = [
+        threading.Thread(target=work)
+        for n in range(max(1, min(workers, len(pending))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(WAIT_INTERVAL)
+    except KeyboardInterrupt:
+        # Jobs run in sessions of their own, so only mush sees the Ctrl-C
+        with condition:
+            del pending[:]
+        kill_running()
+        _join(threads, INTERRUPT_GRACE)
+        raise
+    return [results[job.number] for job in jobs]
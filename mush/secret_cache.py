@@ -0,0 +1,60 @@
+"""
+Keeps the values resolved by access_secret plugins between mush runs, so
+slow secret lookups only happen once per TTL.
+
+A plugin opts in with a 'cache_ttl' option (in seconds) in its config
+section.  Values are stored in a file in the mush cache directory that only
+the user can read, keyed by a hash of the alias, the variable name and the
+raw (unresolved) value, so changing the datastore entry invalidates the
+cached secret.
+"""
+import hashlib
+import sys
+from mush import cache
+
+
+class SecretCache(object):
+
+    def __init__(self, path):
+        self._cache = cache.TTLCache(path)
+
+    @staticmethod
+    def key(alias, variable, raw_value):
+        return hashlib.sha256(
+            "\0".join((alias, variable, raw_value))).hexdigest()
+
+    def lookup(self, alias, environment_variables):
+        """Returns {variable: value} for every variable in
+        environment_variables that has an unexpired cached secret"""
+        hits = dict()
+        for variable, raw_value in environment_variables.items():
+            if not raw_value:
+                continue
+            value = self._cache.get(self.key(alias, variable, raw_value))
+            if value is not None:
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                hits[variable] = value
+        return hits
+
+    def store(self, alias, variable, raw_value, value, ttl):
+        self._cache.set(
+            self.key(alias, variable, raw_value), value, ttl, alias=alias)
+
+    def flush(self, aliases=None):
+        """Removes the cached secrets for aliases, or all of them.  Returns
+        the number of values removed"""
+        if aliases is None:
+            removed = self._cache.remove()
+        else:
+            removed = self._cache.remove(
+                lambda entry: entry.get('alias') in aliases)
+        self.save()
+        return removed
+
+    def save(self):
+        try:
+            self._cache.save()
+        except (IOError, OSError) as exception:
+            print >> sys.stderr, (
+                "Unable to save the secret cache: {0}".format(exception))
@@ -0,0 +1,156 @@
+"""
+Compact in-memory storage for the environments a datastore has loaded.
+
+Most aliases in a datastore share the same variable names and many of the
+same values (auth urls, region names, blank cells), so every distinct value
+is stored once in a value table, every distinct list of variable names is
+stored once, and each alias only keeps an array of indexes into the value
+table.  Environments are handed out as views over that storage instead of
+as freshly built dicts.
+"""
+from array import array
+from collections import MutableMapping, OrderedDict
+
+# Type code of the arrays of value indexes
+INDEX_TYPECODE = 'I'
+
+
+class _Keys(object):
+    """A distinct list of variable names, shared by every alias that has
+    exactly those variables"""
+    __slots__ = ('names', 'positions')
+
+    def __init__(self, names):
+        # Later duplicates win, but a name keeps its first position, just
+        # like building an OrderedDict from the same pairs would.
+        self.positions = dict()
+        unique = list()
+        for i, name in enumerate(names):
+            if name not in self.positions:
+                unique.append(name)
+            self.positions[name] = i
+        self.names = tuple(unique)
+
+
+class _Entry(object):
+    """The stored environment of a single alias"""
+    __slots__ = ('keys', 'indexes')
+
+    def __init__(self, keys, indexes):
+        self.keys = keys
+        self.indexes = indexes
+
+
+class CompactStore(object):
+
+    def __init__(self, values=None):
+        self.values = values or ['']
+        # Only needed when adding values, so built on first use
+        self._value_ids = None
+        self._keys = dict()
+        self._entries = dict()
+
+    def __contains__(self, alias):
+        return alias in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def value_id(self, value):
+        if self._value_ids is None:
+            self._value_ids = dict(
+                (v, i) for i, v in enumerate(self.values))
+        value_id = self._value_ids.get(value)
+        if value_id is None:
+            if type(value) is str:
+                value = intern(value)
+            value_id = len(self.values)
+            self.values.append(value)
+            self._value_ids[value] = value_id
+        return value_id
+
+    def keys(self, names):
+        """Returns the shared _Keys for names"""
+        names = tuple(names)
+        keys = self._keys.get(names)
+        if keys is None:
+            keys = self._keys[names] = _Keys(names)
+        return keys
+
+    def add(self, alias, names, values):
+        """Stores the environment of alias, given as a list of variable
+        names and a list of their values"""
+        self.add_indexes(alias, names, array(
+            INDEX_TYPECODE, [self.value_id(v) for v in values]))
+
+    def add_indexes(self, alias, names, indexes):
+        """Stores the environment of alias, given as a list of variable
+        names and an array of indexes into the value table"""
+        self._entries[alias] = _Entry(self.keys(names), indexes)
+
+    def indexes(self, alias):
+        return self._entries[alias].indexes
+
+    def environment(self, alias):
+        """Returns an EnvironmentView of the stored environment of alias"""
+        return EnvironmentView(self.values, self._entries[alias])
+
+
+class EnvironmentView(MutableMapping):
+    """An ordered mapping of variable name to value for one alias, read
+    from a CompactStore.  The store itself is never modified: values set
+    or deleted on the view are kept by the view alone."""
+
+    def __init__(self, values, entry):
+        self._values = values
+        self._entry = entry
+        self._changes = None
+        self._deleted = None
+
+    def __getitem__(self, key):
+        if self._changes and key in self._changes:
+            return self._changes[key]
+        if self._deleted and key in self._deleted:
+            raise KeyError(key)
+        position = self._entry.keys.positions[key]
+        return self._values[self._entry.indexes[position]]
+
+    def __setitem__(self, key, value):
+        if self._changes is None:
+            self._changes = OrderedDict()
+        self._changes[key] = value
+        if self._deleted:
+            self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self._changes:
+            self._changes.pop(key, None)
+        if key in self._entry.keys.positions:
+            if self._deleted is None:
+                self._deleted = set()
+            self._deleted.add(key)
+
+    def __iter__(self):
+        deleted = self._deleted or ()
+        for key in self._entry.keys.names:
+            if key not in deleted:
+                yield key
+        for key in list(self._changes or ()):
+            if key not in self._entry.keys.positions:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __contains__(self, key):
+        if self._changes and key in self._changes:
+            return True
+        if self._deleted and key in self._deleted:
+            return False
+        return key in self._entry.keys.positions
+
+    def __repr__(self):
+        return "{0}({1!r})".format(
+            self.__class__.__name__, list(self.iteritems()))
@@ -7,7 +7,7 @@ setup(
     description="multi-use-shell-helper...tool...ok, it's a backronymn :)",
     version='1.0.0',
     install_requires=['prettytable'],
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     zip_safe=False,
     entry_points={
         'console_scripts':
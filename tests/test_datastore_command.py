@@ -0,0 +1,44 @@
+"""
+Tests for the machine readable output of 'mush datastore'.  Run with:
+
+    python -m unittest discover tests
+"""
+import json
+import unittest
+from StringIO import StringIO
+
+from mush.cli import CLI
+from mush.store import CompactStore
+
+
+class StreamTests(unittest.TestCase):
+
+    def environments(self):
+        store = CompactStore()
+        store.add('dfw', ['OS_REGION_NAME', 'MUSH_TAGS'], ['DFW', 'prod'])
+        store.add('ord', ['OS_REGION_NAME', 'MUSH_TAGS'], ['ORD', ''])
+        return [(alias, store.environment(alias)) for alias in ('dfw', 'ord')]
+
+    def stream(self, fmt, flags):
+        out = StringIO()
+        CLI.datastore.stream(fmt, self.environments(), flags, out)
+        return out.getvalue()
+
+    def test_json_show_blanks(self):
+        for flags in ({'show-blanks': True},
+                      {'show-blanks': True, 'no-secrets': True}):
+            self.assertEqual(json.loads(self.stream('json', flags)), {
+                'dfw': {'OS_REGION_NAME': 'DFW', 'MUSH_TAGS': 'prod'},
+                'ord': {'OS_REGION_NAME': 'ORD', 'MUSH_TAGS': ''}})
+
+    def test_ndjson_show_blanks(self):
+        lines = self.stream('ndjson', {'show-blanks': True}).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'alias': 'dfw',
+             'variables': {'OS_REGION_NAME': 'DFW', 'MUSH_TAGS': 'prod'}},
+            {'alias': 'ord',
+             'variables': {'OS_REGION_NAME': 'ORD', 'MUSH_TAGS': ''}}])
+
+
+if __name__ == '__main__':
+    unittest.main()